@@ -4,9 +4,13 @@ this is where you'll find all of the get/post request handlers
 the socket event handlers are inside of socket_routes.py
 '''
 
-from flask import Flask, render_template, request, abort, url_for, session, redirect, jsonify
+from flask import Flask, render_template, request, abort, url_for, redirect, jsonify, make_response, g, Response
 from flask_socketio import SocketIO
 import db
+import assets
+import sessions
+import history
+import profiling
 import secrets
 import hashlib
 import re
@@ -27,20 +31,44 @@ app = Flask(__name__)
 app.config['SECRET_KEY'] = secrets.token_hex()
 socketio = SocketIO(app)
 
+# fingerprinted static assets, see assets.py
+assets.init_app(app)
+
 # don't remove this!!
 import socket_routes
 
-def check_session_token():
-    if request.path != 'login' and request.path != '/signup' and not request.path.startswith('/static'):
-        session_token = request.cookies.get('session_token')
-        if not session_token or not db.get_session(session_token):
-            return redirect('/login')
+# on demand profiling, switched on from /admin/profiling. has to come after
+# socket_routes so the socket handlers are registered when they get wrapped
+profiling.init_app(app, socketio)
+
+# pages that can be visited without being logged in
+PUBLIC_ENDPOINTS = {"index", "signup", "signup_user", "login", "login_user", "static", "hashed_asset"}
+
+# the user logged in on this request (or socket event), None if there isn't one.
+# validated once per request, and usually straight from the session cache
+def current_user():
+    if "user" not in g:
+        g.user = sessions.validate(request.cookies.get(sessions.SESSION_COOKIE))
+    return g.user
 
-def authenticate_user(username):
-    if 'username' in session and session['username'] == username:
-        return True 
-    else: 
-        return False
+@app.before_request
+def check_session_token():
+    # request.endpoint is None for unknown urls, let those 404
+    if request.endpoint is None or request.endpoint in PUBLIC_ENDPOINTS:
+        return
+    if current_user() is None:
+        return redirect(url_for('login'))
+
+# response for a successful login/signup, sets the session cookie
+def start_session(username, role_name):
+    token = sessions.create(username, role_name)
+    response = make_response(url_for('home', username=username))
+    response.set_cookie(
+        sessions.SESSION_COOKIE, token,
+        max_age=int(sessions.SESSION_LIFETIME.total_seconds()),
+        secure=True, httponly=True, samesite="Lax",
+    )
+    return response
 
 #def is_valid_username(username):
 #   return str(username).islanum()
@@ -48,9 +76,8 @@ def authenticate_user(username):
 def is_valid_password(password):
     return re.match(r'^(?=.*\d)(?=.*[a-z])(?=.*[A-Z])(?=.*[!@#$%^&*]).{8,}$', password)
 
-def is_staff(username):
-    user = db.get_user(username)
-    return user and user.role.name == "Staff"
+def is_staff(user):
+    return user is not None and user.role_name == "Staff"
 
 # index page
 @app.route("/")
@@ -86,7 +113,7 @@ def signup_user():
         
         if role:
             db.insert_user(username, hashed_password, salt, role.id)
-            return url_for('home', username=username)
+            return start_session(username, role.name)
         else:
             return "Error: Role not found!"
     return "Error: User already exists!"
@@ -116,9 +143,14 @@ def login_user():
     if hashed_input_password != user.password:
         return "Error: Password does not match!"
 
-    session['username'] = username
+    return start_session(user.username, user.role.name)
 
-    return url_for('home', username=request.json.get("username"))
+@app.route("/logout")
+def logout():
+    sessions.end(request.cookies.get(sessions.SESSION_COOKIE))
+    response = redirect(url_for('index'))
+    response.delete_cookie(sessions.SESSION_COOKIE)
+    return response
 
 # handler when a "404" error happens
 @app.errorhandler(404)
@@ -128,9 +160,10 @@ def page_not_found(_):
 # home page, where the messaging app is
 @app.route("/home")
 def home():
-    if request.args.get("username") is None:
-        abort(404)
-    username = request.args.get("username")
+    username = current_user().username
+    # the url carries the username, only the logged in user's own page can be opened
+    if request.args.get("username") != username:
+        return redirect(url_for('home', username=username))
     friends = db.get_friends(username)
     friend_requests = db.get_friend_requests(username)
     sent_friend_requests = db.get_sent_friend_requests(username)
@@ -141,33 +174,70 @@ def home():
 def profile():
     username = request.args.get("username")
     if not username:
-        username = request.cookies.get("username")
-        if not username:
-            return redirect(url_for("login"))
+        username = current_user().username
     user = db.get_user(username)
     if not user:
         abort(404)
     return render_template("profile.jinja", user=user)
 
+# streams the logged in user's messages (or only the ones with ?with=<username>) as NDJSON
+@app.route("/export")
+def export_history():
+    username = current_user().username
+    other = request.args.get("with")
+    response = Response(history.export_ndjson(username, other), mimetype="application/x-ndjson")
+    response.headers["Content-Disposition"] = f"attachment; filename={username}-messages.ndjson"
+    return response
+
+# staff only, how many rooms are open, who is in them and what the registry costs
+@app.route("/admin/rooms")
+def room_stats():
+    if not is_staff(current_user()):
+        abort(403)
+    member_counts = socket_routes.room.member_counts()
+    return jsonify({
+        "rooms": len(member_counts),
+        "members": {str(room_id): count for room_id, count in member_counts.items()},
+        "memory_bytes": socket_routes.room.memory_usage(),
+    })
+
+# staff only, GET shows the per event profiling summary,
+# POST changes the settings, e.g. {"enabled": true, "sample_rate": 0.1, "mode": "sampling"}
+# or clears the summary with {"reset": true}
+@app.route("/admin/profiling", methods=["GET", "POST"])
+def profiling_settings():
+    if not is_staff(current_user()):
+        abort(403)
+    if request.method == "POST":
+        options = request.get_json(silent=True)
+        if not isinstance(options, dict):
+            abort(400)
+        if options.get("reset"):
+            profiling.reset()
+        try:
+            profiling.configure(
+                enabled=options.get("enabled"),
+                sample_rate=options.get("sample_rate"),
+                mode=options.get("mode"),
+                events=options.get("events"),
+            )
+        except ValueError as e:
+            return jsonify({"success": False, "error": str(e)}), 400
+    return jsonify(profiling.summary())
+
 @app.route("/knowledgerepo")
 def knowledge_repo():
-    username = request.cookies.get("username")
-    if not username:
-        return redirect(url_for("login"))
-
-    user = db.get_user(username)
-    if not user:
-        abort(404)
+    user = current_user()
 
     articles = db.get_all_articles()
     for article in articles:
         article.comments = db.get_comments_by_article(article.id)
 
-    return render_template("knowledgerepo.jinja", user=user, articles=articles)
+    return render_template("knowledgerepo.jinja", user=user, username=user.username, articles=articles)
 
 @app.route("/create_article", methods=["POST"])
 def create_article():
-    username = request.cookies.get("username")
+    username = current_user().username
     title = request.json.get("title")
     content = request.json.get("content")
     db.create_article(title, content, username)
@@ -175,14 +245,12 @@ def create_article():
 
 @app.route("/edit_article/<int:article_id>", methods=["POST"])
 def edit_article(article_id):
-    username = request.cookies.get("username")
-    if not username:
-        abort(403)
-
-    user = db.get_user(username)
+    user = current_user()
     article = db.get_article(article_id)
 
-    if not user or (user.role.name != "Staff" and article.author != username):
+    if article is None:
+        abort(404)
+    if not is_staff(user) and article.author != user.username:
         abort(403)
 
     title = request.json.get("title")
@@ -192,14 +260,12 @@ def edit_article(article_id):
 
 @app.route("/delete_article/<int:article_id>", methods=["POST"])
 def delete_article(article_id):
-    username = request.cookies.get("username")
-    if not username:
-        abort(403)
-
-    user = db.get_user(username)
+    user = current_user()
     article = db.get_article(article_id)
 
-    if not user or (user.role.name != "Staff" and article.author != username):
+    if article is None:
+        abort(404)
+    if not is_staff(user) and article.author != user.username:
         abort(403)
 
     db.delete_article(article_id)
@@ -207,29 +273,24 @@ def delete_article(article_id):
 
 @app.route("/create_comment/<int:article_id>", methods=["POST"])
 def create_comment(article_id):
-    username = request.cookies.get("username")
+    username = current_user().username
     content = request.json.get("content")
     db.create_comment(content, username, article_id)
     return jsonify({"success": True})
 
 @app.route("/delete_comment/<int:comment_id>", methods=["POST"])
 def delete_comment(comment_id):
-    username = request.cookies.get("username")
-    if not username:
-        abort(403)
-
-    user = db.get_user(username)
+    user = current_user()
     comment = db.get_comment(comment_id)
 
-    if not user or (user.role.name != "Staff" and comment.author != username):
+    if comment is None:
+        abort(404)
+    if not is_staff(user) and comment.author != user.username:
         abort(403)
 
     db.delete_comment(comment_id)
     return jsonify({"success": True})
 
 if __name__ == '__main__':
-    if not db.get_role_by_name("Student"):
-        db.create_role("Student")
-    if not db.get_role_by_name("Staff"):
-        db.create_role("Staff")
+    # the roles are seeded by migrations.py the first time the database is used
     socketio.run(app, host="0.0.0.0", port="80", debug=True, ssl_context=('cert/cert.pem', 'cert/key.pem'))
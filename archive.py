@@ -0,0 +1,63 @@
+'''
+archive
+cold storage for old messages
+
+the retention job moves messages older than RETENTION_AGE out of the message table
+into gzip compressed NDJSON segment files under database/archive.
+segments are written once and never modified, each one holds messages of a single
+conversation and is indexed by the archive_segment table (conversation + time range).
+db.get_chat_history reads them back when a client asks for history that far back
+
+run `python3 archive.py` (for example from cron) to archive old messages
+'''
+
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Dict, Iterable, Iterator
+import secrets
+import gzip
+import json
+import os
+
+ARCHIVE_DIR = Path("database") / "archive"
+
+# messages older than this are moved to the archive
+RETENTION_AGE = timedelta(days=365)
+
+
+# the archive keys conversations by their usernames in sorted order
+def conversation(user1: str, user2: str):
+    return (user1, user2) if user1 <= user2 else (user2, user1)
+
+# writes the message rows to a new segment file, returns its name inside ARCHIVE_DIR
+def write_segment(rows: Iterable[Dict]) -> str:
+    ARCHIVE_DIR.mkdir(parents=True, exist_ok=True)
+    name = f"{secrets.token_hex(8)}.ndjson.gz"
+    temporary = ARCHIVE_DIR / f"{name}.tmp"
+    with gzip.open(temporary, "wt", encoding="utf-8") as file:
+        for row in rows:
+            record = dict(row)
+            record["timestamp"] = record["timestamp"].isoformat()
+            file.write(json.dumps(record, separators=(",", ":")) + "\n")
+    # the rename makes the segment appear complete or not at all
+    os.replace(temporary, ARCHIVE_DIR / name)
+    return name
+
+def read_segment(name: str) -> Iterator[Dict]:
+    with gzip.open(ARCHIVE_DIR / name, "rt", encoding="utf-8") as file:
+        for line in file:
+            record = json.loads(line)
+            record["timestamp"] = datetime.fromisoformat(record["timestamp"])
+            yield record
+
+
+if __name__ == '__main__':
+    import argparse
+    import db
+
+    parser = argparse.ArgumentParser(description="Move old messages into the compressed archive")
+    parser.add_argument("--days", type=int, default=RETENTION_AGE.days, help="archive messages older than this many days")
+    args = parser.parse_args()
+
+    cutoff = datetime.utcnow() - timedelta(days=args.days)
+    print(f"Archived {db.archive_messages(cutoff)} messages older than {cutoff:%Y-%m-%d %H:%M}")
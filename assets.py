@@ -0,0 +1,183 @@
+'''
+assets
+build step and serving logic for the static JS/CSS assets
+
+the build copies every file under static/js and static/css into static/dist,
+renames it with a content hash (jquery.min.js -> jquery.min.3f2a9c1d0b7e.js)
+and writes gzip (and brotli, if installed) copies next to it.
+since the name changes whenever the content does, the browser can cache these forever
+
+run `python3 assets.py` to (re)build after changing anything in static/js
+'''
+
+from flask import Flask, request, url_for, send_from_directory, abort
+from pathlib import Path
+import hashlib
+import gzip
+import json
+
+try:
+    import brotli
+except ImportError:
+    # brotli is optional, without it we only ship gzip copies
+    brotli = None
+
+STATIC_DIR = Path("static")
+DIST_DIR = STATIC_DIR / "dist"
+MANIFEST_PATH = DIST_DIR / "manifest.json"
+# the hashed names of the last few builds, newest last
+BUILDS_PATH = DIST_DIR / "builds.json"
+
+# builds whose files are kept on disk and served. pages already loaded (or cached)
+# and servers that haven't restarted yet still point at the previous build's names
+KEEP_BUILDS = 3
+
+# folders under static/ that get fingerprinted
+SOURCE_DIRS = ("js", "css")
+
+# one year, the longest max-age browsers honour
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# maps the logical name (same thing you'd pass to url_for('static', filename=...))
+# to the hashed file name inside static/dist
+manifest: dict[str, str] = {}
+# hashed names the /assets route is allowed to serve, from every kept build
+served_files: set[str] = set()
+
+
+def fingerprint(content: bytes) -> str:
+    return hashlib.sha256(content).hexdigest()[:12]
+
+def hashed_name(name: str, digest: str) -> str:
+    path = Path(name)
+    return str(path.with_name(f"{path.stem}.{digest}{path.suffix}").as_posix())
+
+def build() -> dict[str, str]:
+    new_manifest = {}
+    for source_dir in SOURCE_DIRS:
+        root = STATIC_DIR / source_dir
+        if not root.is_dir():
+            continue
+        for source in sorted(root.rglob("*")):
+            if not source.is_file():
+                continue
+            name = source.relative_to(STATIC_DIR).as_posix()
+            content = source.read_bytes()
+            target_name = hashed_name(name, fingerprint(content))
+            target = DIST_DIR / target_name
+            target.parent.mkdir(parents=True, exist_ok=True)
+
+            # the hash is part of the name, so an existing file is already up to date
+            if not target.exists():
+                target.write_bytes(content)
+            gzipped = Path(f"{target}.gz")
+            if not gzipped.exists():
+                # mtime=0 keeps the .gz byte-identical across builds
+                gzipped.write_bytes(gzip.compress(content, compresslevel=9, mtime=0))
+            brotlied = Path(f"{target}.br")
+            if brotli is not None and not brotlied.exists():
+                brotlied.write_bytes(brotli.compress(content, quality=11))
+            new_manifest[name] = target_name
+
+    DIST_DIR.mkdir(parents=True, exist_ok=True)
+    MANIFEST_PATH.write_text(json.dumps(new_manifest, indent=2, sort_keys=True))
+
+    # a rebuild without changes isn't a new generation
+    builds = load_builds()
+    names = sorted(new_manifest.values())
+    if not builds or builds[-1] != names:
+        builds.append(names)
+    builds = builds[-KEEP_BUILDS:]
+    BUILDS_PATH.write_text(json.dumps(builds, indent=2))
+    prune({name for build_names in builds for name in build_names})
+    return new_manifest
+
+def load_builds() -> list[list[str]]:
+    if not BUILDS_PATH.exists():
+        return []
+    return json.loads(BUILDS_PATH.read_text())
+
+# deletes hashed files (and their compressed copies) from builds older than KEEP_BUILDS
+def prune(keep: set[str]):
+    for path in DIST_DIR.rglob("*"):
+        if not path.is_file() or path in (MANIFEST_PATH, BUILDS_PATH):
+            continue
+        name = path.relative_to(DIST_DIR).as_posix()
+        for suffix in (".gz", ".br"):
+            name = name.removesuffix(suffix)
+        if name not in keep:
+            path.unlink()
+
+def load_manifest():
+    manifest.clear()
+    if MANIFEST_PATH.exists():
+        manifest.update(json.loads(MANIFEST_PATH.read_text()))
+
+    # a source edited after the last build would otherwise be silently ignored,
+    # drop those entries so the plain (current) file is served instead
+    stale = []
+    for name, target_name in manifest.items():
+        source = STATIC_DIR / name
+        if not source.is_file() or hashed_name(name, fingerprint(source.read_bytes())) != target_name:
+            stale.append(name)
+    for name in stale:
+        del manifest[name]
+    if stale:
+        print(f"Warning: {', '.join(stale)} changed since the last asset build, run `python3 assets.py`")
+
+    served_files.clear()
+    served_files.update(manifest.values())
+    for build_names in load_builds():
+        served_files.update(build_names)
+
+# used in the templates instead of hardcoding /static/... paths,
+# falls back to the plain static file when the build hasn't been run
+# (or the source was edited since, see load_manifest)
+def asset_url(name: str) -> str:
+    if name in manifest:
+        return url_for("hashed_asset", filename=manifest[name])
+    return url_for("static", filename=name)
+
+def serve_hashed_asset(filename: str):
+    # only serve files the build produced, everything else is a 404
+    if filename not in served_files:
+        abort(404)
+
+    encodings = request.accept_encodings
+    encoding = None
+    path = filename
+    if encodings["br"] and brotli_available(filename):
+        encoding, path = "br", f"{filename}.br"
+    elif encodings["gzip"]:
+        encoding, path = "gzip", f"{filename}.gz"
+
+    response = send_from_directory(
+        DIST_DIR.resolve(), path,
+        mimetype=guess_mimetype(filename),
+        download_name=Path(filename).name,
+    )
+    if encoding is not None:
+        response.headers["Content-Encoding"] = encoding
+    response.headers["Cache-Control"] = IMMUTABLE_CACHE_CONTROL
+    response.vary.add("Accept-Encoding")
+    return response
+
+def brotli_available(filename: str) -> bool:
+    return (DIST_DIR / f"{filename}.br").exists()
+
+def guess_mimetype(filename: str) -> str:
+    if filename.endswith(".js"):
+        return "text/javascript"
+    if filename.endswith(".css"):
+        return "text/css"
+    return "application/octet-stream"
+
+def init_app(app: Flask):
+    load_manifest()
+    app.add_url_rule("/assets/<path:filename>", "hashed_asset", serve_hashed_asset)
+    app.add_template_global(asset_url, "asset_url")
+
+
+if __name__ == '__main__':
+    built = build()
+    print(f"Built {len(built)} assets into {DIST_DIR}")
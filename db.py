@@ -1,28 +1,70 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, Engine, select, insert, delete
 from sqlalchemy.orm import Session, joinedload
 from models import *
 from pathlib import Path
+from datetime import datetime
+import threading
+import migrations
+import archive
 import secrets
 import hashlib
 
-Path("database").mkdir(exist_ok=True)
+DATABASE_URL = "sqlite:///database/main.db"
 
-engine = create_engine("sqlite:///database/main.db", echo=False)
+# the engine is created on first use rather than at import time,
+# so importing db (or a reloader restart) doesn't touch the database
+engine: Engine = None
+engine_lock = threading.Lock()
 
-Base.metadata.create_all(engine)
+def get_engine() -> Engine:
+    global engine
+    if engine is None:
+        with engine_lock:
+            if engine is None:
+                Path("database").mkdir(exist_ok=True)
+                new_engine = create_engine(DATABASE_URL, echo=False)
+                migrations.migrate(new_engine)
+                engine = new_engine
+    return engine
 
 def insert_user(username: str, password: str, salt: str, role_id: int):
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         user = User(username=username, password=password, salt=salt, role_id=role_id)
         session.add(user)
         session.commit()
 
 def get_user(username: str):
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         return session.query(User).options(joinedload(User.role)).get(username)
     
+def create_session(token: str, username: str, expires_at: datetime):
+    with Session(get_engine()) as session:
+        user_session = UserSession(token=token, username=username, expires_at=expires_at)
+        session.add(user_session)
+        session.commit()
+
+def get_session(token: str):
+    with Session(get_engine()) as session:
+        return session.query(UserSession).options(
+            joinedload(UserSession.user).joinedload(User.role)
+        ).get(token)
+
+def delete_session(token: str):
+    with Session(get_engine()) as session:
+        user_session = session.get(UserSession, token)
+        if user_session:
+            session.delete(user_session)
+            session.commit()
+
+# returns how many sessions were deleted
+def delete_expired_sessions(now: datetime) -> int:
+    with Session(get_engine()) as session:
+        deleted = session.query(UserSession).filter(UserSession.expires_at <= now).delete()
+        session.commit()
+        return deleted
+    
 def get_friends(username: str):
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         user = session.get(User, username)
         if user is None:
             return []
@@ -38,21 +80,21 @@ def get_friends(username: str):
         return list(friends)
 
 def get_friend_requests(username: str):
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         friend_requests = session.query(FriendRequest).filter(
             FriendRequest.receiver == username
         ).all()
         return friend_requests
 
 def get_sent_friend_requests(username: str):
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         sent_friend_requests = session.query(FriendRequest).filter(
             FriendRequest.sender == username
         ).all()
         return sent_friend_requests
 
 def send_friend_request(sender: str, receiver: str):
-    session = Session(engine)
+    session = Session(get_engine())
     try:
         friend_request = FriendRequest(sender=sender, receiver=receiver)
         session.add(friend_request)
@@ -64,7 +106,7 @@ def send_friend_request(sender: str, receiver: str):
         session.close()
 
 def accept_friend_request(sender: str, receiver: str):
-    session = Session(engine)
+    session = Session(get_engine())
     try:
         friend_request = session.query(FriendRequest).filter(
             FriendRequest.sender == sender,
@@ -85,7 +127,7 @@ def accept_friend_request(sender: str, receiver: str):
         session.close()
 
 def reject_friend_request(sender: str, receiver: str):
-    session = Session(engine)
+    session = Session(get_engine())
     try:
         friend_request = session.query(FriendRequest).filter(
             FriendRequest.sender == sender,
@@ -103,8 +145,78 @@ def reject_friend_request(sender: str, receiver: str):
     finally:
         session.close()
 
+# sqlite limits how many parameters a statement can have, so long IN (...) lists are split up
+IN_CHUNK_SIZE = 500
+
+def chunks(items: list, size: int = IN_CHUNK_SIZE):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+# the pending requests between one user and many others, loaded inside the caller's transaction.
+# with incoming=True the user is the receiver, otherwise the sender
+def get_pending_friend_requests(session: Session, username: str, others: list, incoming: bool):
+    user_column, other_column = (FriendRequest.receiver, FriendRequest.sender) if incoming else (FriendRequest.sender, FriendRequest.receiver)
+    friend_requests = []
+    for chunk in chunks(list(dict.fromkeys(others))):
+        friend_requests.extend(session.query(FriendRequest).filter(user_column == username, other_column.in_(chunk)).all())
+    return friend_requests
+
+# the users among others that username is already friends with, loaded inside the caller's transaction
+def get_existing_friends(session: Session, username: str, others: list) -> set:
+    friends = set()
+    for chunk in chunks(list(dict.fromkeys(others))):
+        friendships = session.query(Friendship).filter(
+            ((Friendship.user1 == username) & Friendship.user2.in_(chunk)) |
+            ((Friendship.user2 == username) & Friendship.user1.in_(chunk))
+        ).all()
+        friends.update(friendship.user2 if friendship.user1 == username else friendship.user1 for friendship in friendships)
+    return friends
+
+# accepts every request the receiver got from senders in one transaction.
+# returns (accepted, removed): the senders who became friends, and every sender whose
+# request was removed, including stale ones from users who were already friends
+def accept_friend_requests(receiver: str, senders: list):
+    session = Session(get_engine())
+    try:
+        accepted = []
+        removed = []
+        friend_requests = get_pending_friend_requests(session, receiver, senders, incoming=True)
+        existing = get_existing_friends(session, receiver, [friend_request.sender for friend_request in friend_requests])
+        for friend_request in friend_requests:
+            session.delete(friend_request)
+            removed.append(friend_request.sender)
+            # a second friendship row would fail the whole batch on the primary key
+            if friend_request.sender not in existing:
+                session.add(Friendship(user1=friend_request.sender, user2=receiver))
+                accepted.append(friend_request.sender)
+        session.commit()
+        return accepted, removed
+    except:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+# deletes the requests between username and others in one transaction, incoming=True rejects
+# requests username received, incoming=False cancels ones username sent.
+# returns the other users whose requests existed and were removed
+def remove_friend_requests(username: str, others: list, incoming: bool):
+    session = Session(get_engine())
+    try:
+        removed = []
+        for friend_request in get_pending_friend_requests(session, username, others, incoming):
+            session.delete(friend_request)
+            removed.append(friend_request.sender if incoming else friend_request.receiver)
+        session.commit()
+        return removed
+    except:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
 def are_friends(user1: str, user2: str):
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         friendship = session.query(Friendship).filter(
             ((Friendship.user1 == user1) & (Friendship.user2 == user2)) |
             ((Friendship.user1 == user2) & (Friendship.user2 == user1))
@@ -112,7 +224,7 @@ def are_friends(user1: str, user2: str):
         return friendship is not None
     
 def remove_friendship(user1: str, user2: str):
-    session = Session(engine)
+    session = Session(get_engine())
     try:
         friendship1 = session.query(Friendship).filter(
             Friendship.user1 == user1,
@@ -134,56 +246,267 @@ def remove_friendship(user1: str, user2: str):
         session.close()
 
 def insert_message(sender: str, receiver: str, content: str, key: str, mac: str, sender_password: str, receiver_password: str):
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         message = Message(sender=sender, receiver=receiver, content=content, key=key, mac=mac, sender_password=sender_password, receiver_password=receiver_password)
         session.add(message)
         session.commit()
 
-def get_chat_history(user1: str, user2: str, sender_password: str, receiver_password: str):
-    with Session(engine) as session:
-        messages = session.query(Message).filter(
+# returns the messages between the two users, oldest first.
+# with before/limit only a page is returned: the latest `limit` messages older than `before`.
+# messages moved to the archive by the retention job are read back when the page reaches them
+def get_chat_history(user1: str, user2: str, sender_password: str, receiver_password: str, before: datetime = None, limit: int = None):
+    with Session(get_engine()) as session:
+        query = session.query(Message).filter(
             ((Message.sender_password == sender_password) & (Message.receiver_password == receiver_password)) |
             ((Message.sender_password == receiver_password) & (Message.receiver_password == sender_password))
-        ).order_by(Message.timestamp).all()
-        return messages
+        )
+        if before is not None:
+            query = query.filter(Message.timestamp < before)
+        if limit is None:
+            messages = query.order_by(Message.timestamp).all()
+        else:
+            messages = query.order_by(Message.timestamp.desc()).limit(limit).all()
+            messages.reverse()
+            if len(messages) == limit:
+                return messages
+
+        remaining = None if limit is None else limit - len(messages)
+        archived = get_archived_history(session, user1, user2, {sender_password, receiver_password}, before, remaining)
+        if not archived:
+            return messages
+        return sorted(archived + messages, key=lambda message: message.timestamp)
+
+# reads the conversation's archived messages (as detached Message objects), oldest first
+def get_archived_history(session: Session, user1: str, user2: str, passwords: set, before: datetime = None, limit: int = None):
+    user1, user2 = archive.conversation(user1, user2)
+    query = session.query(ArchiveSegment).filter(ArchiveSegment.user1 == user1, ArchiveSegment.user2 == user2)
+    if before is not None:
+        query = query.filter(ArchiveSegment.first_timestamp < before)
+
+    messages = []
+    # newest segments first, so a page only opens the segments it needs
+    for segment in query.order_by(ArchiveSegment.last_timestamp.desc()):
+        if limit is not None and len(messages) >= limit and segment.last_timestamp < messages[0].timestamp:
+            break
+        for row in archive.read_segment(segment.path):
+            if before is not None and row["timestamp"] >= before:
+                continue
+            if {row["sender_password"], row["receiver_password"]} != passwords:
+                continue
+            messages.append(Message(**row))
+        messages.sort(key=lambda message: message.timestamp)
+        if limit is not None:
+            messages = messages[-limit:]
+    return messages
+
+# moves messages older than the cutoff into archive segments, chunk_size messages at a time.
+# returns how many messages were archived
+def archive_messages(cutoff: datetime, chunk_size: int = 50000) -> int:
+    archived = 0
+    while True:
+        with Session(get_engine()) as session:
+            rows = session.execute(
+                select(Message.__table__)
+                .where(Message.timestamp < cutoff)
+                .order_by(Message.id)
+                .limit(chunk_size)
+            ).mappings().all()
+            if not rows:
+                return archived
+
+            conversations = {}
+            for row in rows:
+                conversations.setdefault(archive.conversation(row["sender"], row["receiver"]), []).append(row)
+
+            # the segment files are written before the rows are deleted, if anything fails
+            # in between the messages stay in the table and the file is just never indexed
+            for (user1, user2), conversation_rows in conversations.items():
+                timestamps = [row["timestamp"] for row in conversation_rows]
+                session.add(ArchiveSegment(
+                    user1=user1, user2=user2,
+                    path=archive.write_segment(conversation_rows),
+                    first_timestamp=min(timestamps), last_timestamp=max(timestamps),
+                    message_count=len(conversation_rows),
+                ))
+            # the chunk is exactly the old messages up to the last id read
+            session.execute(delete(Message).where(Message.id <= rows[-1]["id"], Message.timestamp < cutoff))
+            session.commit()
+            archived += len(rows)
+
+# streams messages without loading them all into memory, optionally only the ones
+# a user sent or received, or only the ones between two users.
+# yields one row mapping per message, in insertion order
+def stream_messages(username: str = None, other: str = None, batch_size: int = 1000):
+    query = select(Message.__table__).order_by(Message.id).limit(batch_size)
+    if username is not None and other is not None:
+        query = query.where(
+            ((Message.sender == username) & (Message.receiver == other)) |
+            ((Message.sender == other) & (Message.receiver == username))
+        )
+    elif username is not None:
+        query = query.where((Message.sender == username) | (Message.receiver == username))
+
+    # reads one page per short session (keyset paging on the id), holding a read
+    # transaction open for the whole export would lock out every writer until it finished
+    last_id = 0
+    while True:
+        with Session(get_engine()) as session:
+            rows = session.execute(query.where(Message.id > last_id)).mappings().all()
+        if not rows:
+            return
+        yield from rows
+        last_id = rows[-1]["id"]
+
+# streams the archived messages of a user, of the conversation between two users,
+# or of everyone, segment by segment from the oldest. yields one dict per message
+def stream_archived_messages(username: str = None, other: str = None):
+    with Session(get_engine()) as session:
+        query = session.query(ArchiveSegment.path)
+        if username is not None and other is not None:
+            user1, user2 = archive.conversation(username, other)
+            query = query.filter(ArchiveSegment.user1 == user1, ArchiveSegment.user2 == user2)
+        elif username is not None:
+            query = query.filter((ArchiveSegment.user1 == username) | (ArchiveSegment.user2 == username))
+        paths = [path for (path,) in query.order_by(ArchiveSegment.first_timestamp, ArchiveSegment.id)]
+
+    # the files are read after the session is closed, segments are never modified once indexed
+    for path in paths:
+        yield from archive.read_segment(path)
+
+# inserts message rows (dicts with the Message columns, minus the id) in batches,
+# each batch is a single executemany. everything is one transaction, unless transaction_size
+# is given, then a commit happens every transaction_size rows.
+# returns how many messages were inserted
+def bulk_insert_messages(rows, batch_size: int = 5000, transaction_size: int = None) -> int:
+    inserted = 0
+    uncommitted = 0
+    batch = []
+    connection = get_engine().connect()
+    transaction = connection.begin()
+    try:
+        for row in rows:
+            batch.append(row)
+            if len(batch) < batch_size:
+                continue
+            connection.execute(insert(Message), batch)
+            inserted += len(batch)
+            uncommitted += len(batch)
+            batch = []
+            if transaction_size is not None and uncommitted >= transaction_size:
+                transaction.commit()
+                transaction = connection.begin()
+                uncommitted = 0
+        if batch:
+            connection.execute(insert(Message), batch)
+            inserted += len(batch)
+        transaction.commit()
+    except:
+        transaction.rollback()
+        raise
+    finally:
+        connection.close()
+    return inserted
+
+# creates a group chat with the creator as its only member, returns its id (the room id)
+def create_chat_group(creator: str) -> int:
+    with Session(get_engine()) as session:
+        while True:
+            # 48 bits like the pairwise room ids, so the id stays exact as a JS number
+            group_id = secrets.randbits(48)
+            if session.get(ChatGroup, group_id) is None:
+                break
+        session.add(ChatGroup(id=group_id, created_by=creator))
+        session.add(ChatGroupMember(group_id=group_id, username=creator))
+        session.commit()
+        return group_id
+
+def is_chat_group(group_id: int) -> bool:
+    with Session(get_engine()) as session:
+        return session.get(ChatGroup, group_id) is not None
+
+def is_group_member(group_id: int, username: str) -> bool:
+    with Session(get_engine()) as session:
+        return session.get(ChatGroupMember, (group_id, username)) is not None
+
+# returns False if the group doesn't exist
+def add_group_member(group_id: int, username: str) -> bool:
+    with Session(get_engine()) as session:
+        if session.get(ChatGroup, group_id) is None:
+            return False
+        if session.get(ChatGroupMember, (group_id, username)) is None:
+            session.add(ChatGroupMember(group_id=group_id, username=username))
+            session.commit()
+        return True
 
+def remove_group_member(group_id: int, username: str):
+    with Session(get_engine()) as session:
+        session.query(ChatGroupMember).filter(
+            ChatGroupMember.group_id == group_id, ChatGroupMember.username == username
+        ).delete()
+        session.commit()
+
+def insert_group_message(group_id: int, sender: str, content: str, key: str, mac: str):
+    with Session(get_engine()) as session:
+        session.add(GroupMessage(group_id=group_id, sender=sender, content=content, key=key, mac=mac))
+        session.commit()
+
+# like get_chat_history, for a group chat. oldest first
+def get_group_history(group_id: int, before: datetime = None, limit: int = None):
+    with Session(get_engine()) as session:
+        query = session.query(GroupMessage).filter(GroupMessage.group_id == group_id)
+        if before is not None:
+            query = query.filter(GroupMessage.timestamp < before)
+        if limit is None:
+            return query.order_by(GroupMessage.timestamp).all()
+        messages = query.order_by(GroupMessage.timestamp.desc()).limit(limit).all()
+        messages.reverse()
+        return messages
 
 def send_chat_invitation(sender: str, receiver: str, room_id: int):
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         invitation = ChatInvitation(sender=sender, receiver=receiver, room_id=room_id)
         session.add(invitation)
         session.commit()
 
 def get_chat_invitations(username: str):
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         invitations = session.query(ChatInvitation).filter(ChatInvitation.receiver == username).all()
         return invitations
 
-def remove_chat_invitation(invitation_id: int):
-    with Session(engine) as session:
-        invitation = session.get(ChatInvitation, invitation_id)
-        if invitation:
+# deletes the receiver's invitations with the given ids in one transaction and returns them,
+# used both to accept (the caller joins the rooms) and to reject invitations.
+# ids that don't exist or belong to someone else are skipped
+def take_chat_invitations(receiver: str, invitation_ids: list):
+    with Session(get_engine()) as session:
+        invitations = []
+        for chunk in chunks(list(dict.fromkeys(invitation_ids))):
+            invitations.extend(session.query(ChatInvitation).filter(
+                ChatInvitation.receiver == receiver,
+                ChatInvitation.id.in_(chunk)
+            ).all())
+        for invitation in invitations:
             session.delete(invitation)
-            session.commit()
+        session.commit()
+        return invitations
 
 def create_article(title: str, content: str, author: str):
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         article = KnowledgeArticle(title=title, content=content, author=author)
         session.add(article)
         session.commit()
 
 def get_all_articles():
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         articles = session.query(KnowledgeArticle).all()
         return articles
 
 def get_article(article_id: int):
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         article = session.get(KnowledgeArticle, article_id)
         return article
 
 def update_article(article_id: int, title: str, content: str):
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         article = session.get(KnowledgeArticle, article_id)
         if article:
             article.title = title
@@ -191,48 +514,48 @@ def update_article(article_id: int, title: str, content: str):
             session.commit()
 
 def delete_article(article_id: int):
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         article = session.get(KnowledgeArticle, article_id)
         if article:
             session.delete(article)
             session.commit()
 
 def create_comment(content: str, author: str, article_id: int):
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         comment = Comment(content=content, author=author, article_id=article_id)
         session.add(comment)
         session.commit()
 
 def get_comment(comment_id: int):
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         return session.query(Comment).get(comment_id)
 
 def get_comments_by_article(article_id: int):
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         comments = session.query(Comment).filter(Comment.article_id == article_id).all()
         return comments
 
 def delete_comment(comment_id: int):
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         comment = session.get(Comment, comment_id)
         if comment:
             session.delete(comment)
             session.commit()
 
 def create_role(name: str):
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         role = Role(name=name)
         session.add(role)
         session.commit()
         return role.id
 
 def get_role_by_name(name: str):
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         role = session.query(Role).filter(Role.name == name).first()
         return role
 
 def assign_role_to_user(username: str, role_id: int):
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         user = session.get(User, username)
         if user:
             user.role_id = role_id
@@ -0,0 +1,119 @@
+'''
+history
+export and import of chat history as NDJSON (one JSON object per line)
+
+exports are streamed straight from the database and the archive segments, so memory stays flat
+no matter how big the history is. imports are inserted in large batches
+
+usage:
+    python3 history.py export [--user alice [--with bob]] [--include-passwords] > backup.ndjson
+    python3 history.py import backup.ndjson
+'''
+
+from datetime import datetime
+from typing import Dict, Iterable, Iterator, Optional
+import itertools
+import argparse
+import json
+import sys
+import db
+
+# columns that are exported, the id is left out since the importing database assigns its own
+EXPORTED_FIELDS = ("sender", "receiver", "content", "key", "mac", "timestamp")
+# the password hashes the chat history is looked up by, only exported for server side backups
+PASSWORD_FIELDS = ("sender_password", "receiver_password")
+
+
+# one NDJSON line per message, the archived ones (which are the oldest) first
+def export_ndjson(username: str = None, other: str = None, include_passwords: bool = False) -> Iterator[str]:
+    fields = EXPORTED_FIELDS + PASSWORD_FIELDS if include_passwords else EXPORTED_FIELDS
+    rows = itertools.chain(db.stream_archived_messages(username, other), db.stream_messages(username, other))
+    for row in rows:
+        record = {field: row[field] for field in fields}
+        record["timestamp"] = record["timestamp"].isoformat() if record["timestamp"] else None
+        yield json.dumps(record, separators=(",", ":")) + "\n"
+
+# columns every imported message needs
+REQUIRED_FIELDS = ("sender", "receiver", "content", "key", "mac")
+
+
+# turns NDJSON lines back into Message rows, filling in the password hashes
+# from the user table when the export didn't include them.
+# raises ValueError, with the line number, for a line that isn't a valid message
+def parse_ndjson(lines: Iterable[str]) -> Iterator[Dict]:
+    passwords: Dict[str, Optional[str]] = {}
+
+    def password_of(username: str) -> Optional[str]:
+        if username not in passwords:
+            user = db.get_user(username)
+            passwords[username] = user.password if user else None
+        return passwords[username]
+
+    for line_number, line in enumerate(lines, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Line {line_number} is not valid JSON: {e}")
+        if not isinstance(record, dict):
+            raise ValueError(f"Line {line_number} is not a JSON object")
+
+        row = {field: record.get(field) for field in EXPORTED_FIELDS}
+        for field in REQUIRED_FIELDS:
+            if not isinstance(row[field], str):
+                raise ValueError(f"Line {line_number}: {field} must be a string")
+        if row["timestamp"] is None:
+            row["timestamp"] = datetime.utcnow()
+        else:
+            try:
+                row["timestamp"] = datetime.fromisoformat(row["timestamp"])
+            except (TypeError, ValueError):
+                raise ValueError(f"Line {line_number}: invalid timestamp {row['timestamp']!r}")
+
+        for field, username in (("sender_password", row["sender"]), ("receiver_password", row["receiver"])):
+            password = record.get(field) or password_of(username)
+            if not isinstance(password, str):
+                raise ValueError(f"Line {line_number}: unknown user {username}, export with --include-passwords to import it")
+            row[field] = password
+        yield row
+
+# the whole import is one transaction by default, so a bad line leaves the database
+# as it was and the file can simply be imported again once it's fixed.
+# commit_every commits every that many rows instead, which lets other writers in during
+# a very large import, but a failed import then has to be cleaned up before retrying
+def import_ndjson(lines: Iterable[str], commit_every: int = None) -> int:
+    return db.bulk_insert_messages(parse_ndjson(lines), transaction_size=commit_every)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export or import chat history as NDJSON")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = commands.add_parser("export", help="write messages to stdout")
+    export_parser.add_argument("--user", help="only messages this user sent or received")
+    export_parser.add_argument("--with", dest="other", help="only the conversation between --user and this user")
+    export_parser.add_argument("--include-passwords", action="store_true", help="include the password hashes, for full restores")
+
+    import_parser = commands.add_parser("import", help="insert messages from an NDJSON file")
+    import_parser.add_argument("file", help="NDJSON file to import, - for stdin")
+    import_parser.add_argument("--commit-every", type=int, help="commit every N messages instead of importing in one transaction")
+
+    args = parser.parse_args()
+    if args.command == "export":
+        if args.other and not args.user:
+            parser.error("--with needs --user")
+        sys.stdout.writelines(export_ndjson(args.user, args.other, args.include_passwords))
+    else:
+        try:
+            if args.file == "-":
+                count = import_ndjson(sys.stdin, args.commit_every)
+            else:
+                with open(args.file, encoding="utf-8") as file:
+                    count = import_ndjson(file, args.commit_every)
+        except ValueError as e:
+            if args.commit_every:
+                sys.exit(f"Import failed, the messages up to the last commit were kept: {e}")
+            sys.exit(f"Import failed, nothing was imported: {e}")
+        print(f"Imported {count} messages", file=sys.stderr)
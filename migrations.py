@@ -0,0 +1,265 @@
+'''
+migrations
+versioned schema migrations for the sqlite database
+
+every migration has a version number and runs exactly once, in order.
+the versions that already ran are recorded in the schema_version table,
+so starting the app only costs one query once the database is up to date
+
+to change the schema, append a new migration at the bottom of this file,
+never edit one that has already been released
+'''
+
+from sqlalchemy import Engine, Connection, Table, text, select, insert
+from models import *
+from typing import Callable, List, NamedTuple
+from datetime import datetime
+
+
+class Migration(NamedTuple):
+    version: int
+    description: str
+    upgrade: Callable[[Connection], None]
+
+# ordered list of every migration, filled in by the @migration decorator
+MIGRATIONS: List[Migration] = []
+
+def register(version: int, description: str, upgrade: Callable[[Connection], None]):
+    if MIGRATIONS and MIGRATIONS[-1].version >= version:
+        raise ValueError(f"Migration {version} is out of order")
+    MIGRATIONS.append(Migration(version, description, upgrade))
+
+def migration(version: int, description: str):
+    def decorator(upgrade: Callable[[Connection], None]):
+        register(version, description, upgrade)
+        return upgrade
+    return decorator
+
+# index builds get a migration each, so every index is built in its own short
+# transaction. sqlite has no CREATE INDEX CONCURRENTLY, so this is the closest we get
+# to an online build: writers are only held up for one index at a time
+def online_index(version: int, table: Table, name: str):
+    index = next(index for index in table.indexes if index.name == name)
+    def upgrade(connection: Connection):
+        index.create(connection, checkfirst=True)
+    register(version, f"create index {name}", upgrade)
+
+
+def ensure_version_table(connection: Connection):
+    connection.execute(text(
+        "CREATE TABLE IF NOT EXISTS schema_version ("
+        "version INTEGER PRIMARY KEY, "
+        "description VARCHAR NOT NULL, "
+        "applied_at DATETIME NOT NULL)"
+    ))
+
+def current_version(connection: Connection) -> int:
+    version = connection.execute(text("SELECT MAX(version) FROM schema_version")).scalar()
+    return version or 0
+
+def has_version_table(connection: Connection) -> bool:
+    return connection.execute(text(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'schema_version'"
+    )).first() is not None
+
+# takes sqlite's write lock at the start of the transaction, so when several processes
+# start at once, the others wait here instead of reading a version that's about to change
+def lock(connection: Connection):
+    connection.exec_driver_sql("BEGIN IMMEDIATE")
+
+# brings the database up to the latest version, returns the version it ended on
+def migrate(engine: Engine) -> int:
+    # usually there's nothing to do. checking that only reads, so startup doesn't
+    # wait on the write lock behind a long writer (the archive job, a big import)
+    with engine.connect() as connection:
+        if has_version_table(connection):
+            version = current_version(connection)
+            if not MIGRATIONS or version >= MIGRATIONS[-1].version:
+                return version
+
+    with engine.begin() as connection:
+        lock(connection)
+        ensure_version_table(connection)
+        version = current_version(connection)
+
+    for step in MIGRATIONS:
+        if step.version <= version:
+            continue
+        # each migration commits together with its schema_version row,
+        # so a crash halfway leaves the database at the previous version
+        with engine.begin() as connection:
+            lock(connection)
+            # another process may have applied it while we waited for the lock
+            version = current_version(connection)
+            if step.version <= version:
+                continue
+            step.upgrade(connection)
+            connection.execute(
+                text("INSERT INTO schema_version (version, description, applied_at) VALUES (:version, :description, :applied_at)"),
+                {"version": step.version, "description": step.description, "applied_at": datetime.utcnow()},
+            )
+        print(f"Applied migration {step.version}: {step.description}")
+        version = step.version
+    return version
+
+
+# migrations, oldest first
+
+# the tables as they were before migrations existed, written out rather than taken
+# from the models so later changes to the models don't leak into it.
+# IF NOT EXISTS makes this a no-op for databases created by the old create_all at import time
+BASELINE_DDL = [
+    """CREATE TABLE IF NOT EXISTS role (
+        id INTEGER NOT NULL,
+        name VARCHAR NOT NULL,
+        PRIMARY KEY (id)
+    )""",
+    """CREATE TABLE IF NOT EXISTS user (
+        username VARCHAR NOT NULL,
+        password VARCHAR NOT NULL,
+        salt VARCHAR NOT NULL,
+        role_id INTEGER NOT NULL,
+        PRIMARY KEY (username),
+        FOREIGN KEY(role_id) REFERENCES role (id)
+    )""",
+    """CREATE TABLE IF NOT EXISTS friendship (
+        user1 VARCHAR NOT NULL,
+        user2 VARCHAR NOT NULL,
+        PRIMARY KEY (user1, user2)
+    )""",
+    """CREATE TABLE IF NOT EXISTS friend_request (
+        sender VARCHAR NOT NULL,
+        receiver VARCHAR NOT NULL,
+        PRIMARY KEY (sender, receiver)
+    )""",
+    """CREATE TABLE IF NOT EXISTS message (
+        id INTEGER NOT NULL,
+        sender VARCHAR NOT NULL,
+        receiver VARCHAR NOT NULL,
+        content VARCHAR NOT NULL,
+        "key" VARCHAR NOT NULL,
+        mac VARCHAR NOT NULL,
+        sender_password VARCHAR NOT NULL,
+        receiver_password VARCHAR NOT NULL,
+        timestamp DATETIME NOT NULL,
+        PRIMARY KEY (id)
+    )""",
+    """CREATE TABLE IF NOT EXISTS chat_invitation (
+        id INTEGER NOT NULL,
+        sender VARCHAR NOT NULL,
+        receiver VARCHAR NOT NULL,
+        room_id INTEGER NOT NULL,
+        PRIMARY KEY (id),
+        FOREIGN KEY(sender) REFERENCES user (username),
+        FOREIGN KEY(receiver) REFERENCES user (username)
+    )""",
+    """CREATE TABLE IF NOT EXISTS knowledge_article (
+        id INTEGER NOT NULL,
+        title VARCHAR NOT NULL,
+        content VARCHAR NOT NULL,
+        author VARCHAR NOT NULL,
+        PRIMARY KEY (id),
+        FOREIGN KEY(author) REFERENCES user (username)
+    )""",
+    """CREATE TABLE IF NOT EXISTS comment (
+        id INTEGER NOT NULL,
+        content VARCHAR NOT NULL,
+        author VARCHAR NOT NULL,
+        article_id INTEGER NOT NULL,
+        PRIMARY KEY (id),
+        FOREIGN KEY(author) REFERENCES user (username),
+        FOREIGN KEY(article_id) REFERENCES knowledge_article (id)
+    )""",
+]
+
+@migration(1, "baseline schema")
+def create_baseline(connection: Connection):
+    for statement in BASELINE_DDL:
+        connection.execute(text(statement))
+
+@migration(2, "seed roles")
+def seed_roles(connection: Connection):
+    existing = set(connection.execute(select(Role.name)).scalars())
+    for name in ("Student", "Staff"):
+        if name not in existing:
+            connection.execute(insert(Role).values(name=name))
+
+online_index(3, Message.__table__, "ix_message_conversation")
+online_index(4, Friendship.__table__, "ix_friendship_user2")
+online_index(5, FriendRequest.__table__, "ix_friend_request_receiver")
+online_index(6, ChatInvitation.__table__, "ix_chat_invitation_receiver")
+online_index(7, Comment.__table__, "ix_comment_article_id")
+
+# tables are written out as they were when the migration was released, like the baseline
+@migration(8, "session table")
+def create_session_table(connection: Connection):
+    connection.execute(text(
+        "CREATE TABLE IF NOT EXISTS session ("
+        "token VARCHAR NOT NULL, "
+        "username VARCHAR NOT NULL, "
+        "expires_at DATETIME NOT NULL, "
+        "PRIMARY KEY (token), "
+        "FOREIGN KEY(username) REFERENCES user (username))"
+    ))
+    connection.execute(text("CREATE INDEX IF NOT EXISTS ix_session_expires_at ON session (expires_at)"))
+
+online_index(9, Message.__table__, "ix_message_timestamp")
+
+@migration(10, "archive segment table")
+def create_archive_segment_table(connection: Connection):
+    connection.execute(text(
+        "CREATE TABLE IF NOT EXISTS archive_segment ("
+        "id INTEGER NOT NULL, "
+        "user1 VARCHAR NOT NULL, "
+        "user2 VARCHAR NOT NULL, "
+        "path VARCHAR NOT NULL, "
+        "first_timestamp DATETIME NOT NULL, "
+        "last_timestamp DATETIME NOT NULL, "
+        "message_count INTEGER NOT NULL, "
+        "PRIMARY KEY (id))"
+    ))
+    connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_archive_segment_conversation "
+        "ON archive_segment (user1, user2, first_timestamp)"
+    ))
+
+@migration(11, "group chat tables")
+def create_group_chat_tables(connection: Connection):
+    connection.execute(text(
+        "CREATE TABLE IF NOT EXISTS chat_group ("
+        "id INTEGER NOT NULL, "
+        "created_by VARCHAR NOT NULL, "
+        "created_at DATETIME NOT NULL, "
+        "PRIMARY KEY (id), "
+        "FOREIGN KEY(created_by) REFERENCES user (username))"
+    ))
+    connection.execute(text(
+        "CREATE TABLE IF NOT EXISTS chat_group_member ("
+        "group_id INTEGER NOT NULL, "
+        "username VARCHAR NOT NULL, "
+        "PRIMARY KEY (group_id, username), "
+        "FOREIGN KEY(group_id) REFERENCES chat_group (id), "
+        "FOREIGN KEY(username) REFERENCES user (username))"
+    ))
+    connection.execute(text(
+        "CREATE TABLE IF NOT EXISTS group_message ("
+        "id INTEGER NOT NULL, "
+        "group_id INTEGER NOT NULL, "
+        "sender VARCHAR NOT NULL, "
+        "content VARCHAR NOT NULL, "
+        "\"key\" VARCHAR NOT NULL, "
+        "mac VARCHAR NOT NULL, "
+        "timestamp DATETIME NOT NULL, "
+        "PRIMARY KEY (id), "
+        "FOREIGN KEY(group_id) REFERENCES chat_group (id))"
+    ))
+    connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_group_message_group ON group_message (group_id, timestamp)"
+    ))
+
+
+if __name__ == '__main__':
+    # db.get_engine() runs the migrations the first time it's called
+    import db
+    with db.get_engine().connect() as connection:
+        print(f"Database is at schema version {current_version(connection)}")
@@ -10,10 +10,13 @@ Prisma docs also looks so much better in comparison
 or use SQLite, if you're not into fancy ORMs (but be mindful of Injection attacks :) )
 '''
 
-from sqlalchemy import String, Integer, DateTime, ForeignKey, Boolean
+from sqlalchemy import String, Integer, DateTime, ForeignKey, Boolean, Index
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
-from typing import Dict
+from typing import Dict, List, Set, FrozenSet, Tuple
 from datetime import datetime
+import threading
+import hashlib
+import sys
 
 
 
@@ -40,60 +43,184 @@ class Role(Base):
     __tablename__ = "role"
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     name: Mapped[str] = mapped_column(String)
-    
 
-# stateful counter used to generate the room id
-class Counter():
-    def __init__(self):
-        self.counter = 0
+# server side login session, the token is what the browser holds in its session_token cookie
+class UserSession(Base):
+    __tablename__ = "session"
+    # the sweeper deletes expired rows by expires_at
+    __table_args__ = (Index("ix_session_expires_at", "expires_at"),)
+
+    token: Mapped[str] = mapped_column(String, primary_key=True)
+    username: Mapped[str] = mapped_column(String, ForeignKey("user.username"))
+    expires_at: Mapped[datetime] = mapped_column(DateTime)
+    user: Mapped["User"] = relationship("User")
     
-    def get(self):
-        self.counter += 1
-        return self.counter
+
+# one chat room. rooms are created and dropped all the time,
+# __slots__ keeps each record down to the two fields
+class RoomRecord():
+    __slots__ = ("id", "members")
+
+    def __init__(self, room_id: int):
+        self.id = room_id
+        # username -> the socket ids (browser tabs) the user is in the room with
+        self.members: Dict[str, Set[str]] = {}
 
 # Room class, used to keep track of which username is in which room
+# indexed both ways, so finding a user's rooms or a room's members never scans everything
 class Room():
     def __init__(self):
-        self.counter = Counter()
-        # dictionary that maps the username to the room id
-        # for example self.dict["John"] -> gives you the room id of 
-        # the room where John is in
-        self.dict: Dict[str, int] = {}
-
-    def create_room(self, sender: str, receiver: str) -> int:
-        room_id = self.counter.get()
-        self.dict[sender] = room_id
-        self.dict[receiver] = room_id
-        return room_id
-    
-    def join_room(self,  sender: str, room_id: int) -> int:
-        self.dict[sender] = room_id
+        # room id -> the room and its members
+        self.rooms: Dict[int, RoomRecord] = {}
+        # username -> ids of the rooms the user is in
+        # for example self.user_rooms["John"] -> the rooms John is chatting in
+        self.user_rooms: Dict[str, Set[int]] = {}
+        # socket id -> (username, ids of the rooms joined from that socket),
+        # so a closed tab can be taken out of its rooms on disconnect
+        self.sid_rooms: Dict[str, Tuple[str, Set[int]]] = {}
+        # socket.io handlers run on several threads, the indexes are updated together
+        self.lock = threading.Lock()
+
+    # the room id of a conversation, derived from the usernames
+    # so it's the same across restarts and processes
+    @staticmethod
+    def room_id_for(*usernames: str) -> int:
+        key = "\x00".join(sorted(set(usernames)))
+        # 48 bits, so the id stays exact as a JS number
+        return int.from_bytes(hashlib.sha256(key.encode()).digest()[:6], "big")
+
+    def join_room(self, user: str, room_id: int, sid: str):
+        with self.lock:
+            record = self.rooms.get(room_id)
+            if record is None:
+                record = self.rooms[room_id] = RoomRecord(room_id)
+            record.members.setdefault(user, set()).add(sid)
+            self.user_rooms.setdefault(user, set()).add(room_id)
+            self.sid_rooms.setdefault(sid, (user, set()))[1].add(room_id)
 
-    def leave_room(self, user):
-        if user not in self.dict.keys():
+    # takes the user out of the room (from every tab), must be called with the lock held
+    def _remove_member(self, user: str, room_id: int):
+        record = self.rooms.get(room_id)
+        if record is not None:
+            for sid in record.members.pop(user, ()):
+                entry = self.sid_rooms.get(sid)
+                if entry is not None:
+                    entry[1].discard(room_id)
+                    if not entry[1]:
+                        del self.sid_rooms[sid]
+            if not record.members:
+                del self.rooms[room_id]
+        user_rooms = self.user_rooms.get(user)
+        if user_rooms is not None:
+            user_rooms.discard(room_id)
+            if not user_rooms:
+                del self.user_rooms[user]
+
+    # leaves one room, or every room the user is in if room_id is None.
+    # with a sid only that socket leaves, the user stays if another of their tabs is still in the room
+    def leave_room(self, user: str, room_id: int = None, sid: str = None):
+        with self.lock:
+            if sid is None:
+                room_ids = list(self.user_rooms.get(user, ())) if room_id is None else [room_id]
+                for left in room_ids:
+                    self._remove_member(user, left)
+                return
+            entry = self.sid_rooms.get(sid)
+            if entry is None or entry[0] != user:
+                return
+            room_ids = list(entry[1]) if room_id is None else [room_id]
+            for left in room_ids:
+                self._remove_sid(user, left, sid)
+
+    # a socket went away, the user stays in a room only if another of their tabs is in it.
+    # returns the ids of the rooms the user is no longer in
+    def disconnect(self, sid: str) -> List[int]:
+        with self.lock:
+            entry = self.sid_rooms.get(sid)
+            if entry is None:
+                return []
+            user, room_ids = entry
+            left = []
+            for room_id in list(room_ids):
+                self._remove_sid(user, room_id, sid)
+                if room_id not in self.user_rooms.get(user, ()):
+                    left.append(room_id)
+            return left
+
+    # must be called with the lock held
+    def _remove_sid(self, user: str, room_id: int, sid: str):
+        entry = self.sid_rooms.get(sid)
+        if entry is not None:
+            entry[1].discard(room_id)
+            if not entry[1]:
+                del self.sid_rooms[sid]
+        record = self.rooms.get(room_id)
+        if record is None or sid not in record.members.get(user, ()):
             return
-        del self.dict[user]
+        record.members[user].discard(sid)
+        if not record.members[user]:
+            self._remove_member(user, room_id)
+
+    # usernames of the room's members
+    def get_members(self, room_id: int) -> FrozenSet[str]:
+        with self.lock:
+            record = self.rooms.get(room_id)
+            return frozenset(record.members) if record else frozenset()
+
+    # the sockets messages and notices for the room are delivered to
+    def get_sids(self, room_id: int) -> FrozenSet[str]:
+        with self.lock:
+            record = self.rooms.get(room_id)
+            if record is None:
+                return frozenset()
+            return frozenset(sid for sids in record.members.values() for sid in sids)
+
+    def is_member(self, user: str, room_id: int) -> bool:
+        with self.lock:
+            record = self.rooms.get(room_id)
+            return record is not None and user in record.members
+
+    def member_counts(self) -> Dict[int, int]:
+        with self.lock:
+            return {room_id: len(record.members) for room_id, record in self.rooms.items()}
 
-    # gets the room id from a user
-    def get_room_id(self, user: str):
-        if user not in self.dict.keys():
-            return None
-        return self.dict[user]
+    # approximate bytes held by the registry, the username and socket id strings
+    # aren't counted since they're shared with the rest of the app
+    def memory_usage(self) -> int:
+        with self.lock:
+            size = sum(sys.getsizeof(index) for index in (self.rooms, self.user_rooms, self.sid_rooms))
+            for record in self.rooms.values():
+                size += sys.getsizeof(record) + sys.getsizeof(record.members)
+                size += sum(sys.getsizeof(sids) for sids in record.members.values())
+            for room_ids in self.user_rooms.values():
+                size += sys.getsizeof(room_ids)
+            for entry in self.sid_rooms.values():
+                size += sys.getsizeof(entry) + sys.getsizeof(entry[1])
+            return size
     
 class Friendship(Base):
     __tablename__ = "friendship"
+    # the primary key already covers lookups by user1
+    __table_args__ = (Index("ix_friendship_user2", "user2"),)
 
     user1: Mapped[str] = mapped_column(String, primary_key=True)
     user2: Mapped[str] = mapped_column(String, primary_key=True)
 
 class FriendRequest(Base):
     __tablename__ = "friend_request"
+    __table_args__ = (Index("ix_friend_request_receiver", "receiver"),)
 
     sender: Mapped[str] = mapped_column(String, primary_key=True)
     receiver: Mapped[str] = mapped_column(String, primary_key=True)
 
 class Message(Base):
     __tablename__ = "message"
+    # get_chat_history looks messages up by the password pair and sorts by time,
+    # the retention job looks for messages older than a cutoff
+    __table_args__ = (
+        Index("ix_message_conversation", "sender_password", "receiver_password", "timestamp"),
+        Index("ix_message_timestamp", "timestamp"),
+    )
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
     sender: Mapped[str] = mapped_column(String)
@@ -105,14 +232,58 @@ class Message(Base):
     receiver_password: Mapped[str] = mapped_column(String)
     timestamp: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
 
+# a compressed file of messages moved out of the message table by the retention job,
+# see archive.py. user1 and user2 are the conversation's usernames in sorted order
+class ArchiveSegment(Base):
+    __tablename__ = "archive_segment"
+    __table_args__ = (Index("ix_archive_segment_conversation", "user1", "user2", "first_timestamp"),)
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    user1: Mapped[str] = mapped_column(String)
+    user2: Mapped[str] = mapped_column(String)
+    path: Mapped[str] = mapped_column(String)
+    first_timestamp: Mapped[datetime] = mapped_column(DateTime)
+    last_timestamp: Mapped[datetime] = mapped_column(DateTime)
+    message_count: Mapped[int] = mapped_column(Integer)
+
 class ChatInvitation(Base):
     __tablename__ = "chat_invitation"
+    __table_args__ = (Index("ix_chat_invitation_receiver", "receiver"),)
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
     sender: Mapped[str] = mapped_column(String, ForeignKey("user.username"))
     receiver: Mapped[str] = mapped_column(String, ForeignKey("user.username"))
     room_id: Mapped[int] = mapped_column(Integer)
 
+# a group chat. its id is the socket.io room id, drawn at random so it never
+# lines up with a pairwise conversation's id (see Room.room_id_for)
+class ChatGroup(Base):
+    __tablename__ = "chat_group"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=False)
+    created_by: Mapped[str] = mapped_column(String, ForeignKey("user.username"))
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+# who is in a group chat, users are added by accepting an invitation
+class ChatGroupMember(Base):
+    __tablename__ = "chat_group_member"
+
+    group_id: Mapped[int] = mapped_column(Integer, ForeignKey("chat_group.id"), primary_key=True)
+    username: Mapped[str] = mapped_column(String, ForeignKey("user.username"), primary_key=True)
+
+# messages of a group chat are stored by group, not by a sender/receiver pair
+class GroupMessage(Base):
+    __tablename__ = "group_message"
+    __table_args__ = (Index("ix_group_message_group", "group_id", "timestamp"),)
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    group_id: Mapped[int] = mapped_column(Integer, ForeignKey("chat_group.id"))
+    sender: Mapped[str] = mapped_column(String)
+    content: Mapped[str] = mapped_column(String)
+    key: Mapped[str] = mapped_column(String)
+    mac: Mapped[str] = mapped_column(String)
+    timestamp: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
 class KnowledgeArticle(Base):
     __tablename__ = "knowledge_article"
 
@@ -123,6 +294,7 @@ class KnowledgeArticle(Base):
 
 class Comment(Base):
     __tablename__ = "comment"
+    __table_args__ = (Index("ix_comment_article_id", "article_id"),)
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
     content: Mapped[str] = mapped_column(String)
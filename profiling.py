@@ -0,0 +1,397 @@
+'''
+profiling
+on demand profiling of routes and socket events
+
+off by default. staff can switch it on while the app is running from /admin/profiling,
+then a sample of requests and socket events is profiled, either with cProfile
+or with a low overhead stack sampler, together with the SQL statements each one issued.
+every profile is saved under profiles/<event name>/ and summarised per event name
+
+cProfile profiles (.prof) can be opened with `python3 -m pstats`, sampled ones (.folded)
+are in the collapsed stack format flamegraph tools read
+'''
+
+from flask import Flask, g, request
+from flask_socketio import SocketIO
+from sqlalchemy import event as sqlalchemy_event
+from collections import Counter
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Optional
+import functools
+import cProfile
+import pstats
+import threading
+import secrets
+import queue
+import random
+import json
+import time
+import sys
+import re
+import db
+
+PROFILE_DIR = Path("profiles")
+MODES = ("cprofile", "sampling")
+# seconds between two stack samples in sampling mode
+SAMPLING_INTERVAL = 0.005
+# how many functions/statements the summary lists per event
+SUMMARY_SIZE = 10
+# fraction of requests/events profiled unless configured otherwise,
+# low so switching profiling on under load doesn't fill the disk
+DEFAULT_SAMPLE_RATE = 0.01
+# profiles kept on disk per event name, the oldest are deleted past this
+MAX_PROFILES_PER_EVENT = 100
+# the admin endpoint isn't profiled, it would only measure itself
+IGNORED_EVENTS = {"http:profiling_settings"}
+# finished profiles waiting to be written, past this new ones are dropped
+MAX_PENDING_PROFILES = 100
+
+
+# what gets profiled, changed at runtime through configure()
+class Settings():
+    def __init__(self):
+        self.enabled = False
+        # fraction of requests/events that get profiled
+        self.sample_rate = DEFAULT_SAMPLE_RATE
+        self.mode = "cprofile"
+        # only profile these event names, None profiles everything
+        self.events: Optional[set] = None
+
+settings = Settings()
+
+# one profiled request or socket event
+class Profile():
+    def __init__(self, event: str, mode: str):
+        self.event = event
+        self.mode = mode
+        self.started_at = datetime.utcnow()
+        self.started = time.perf_counter()
+        self.duration = 0.0
+        # (statement, seconds) for every SQL statement the handler ran
+        self.statements = []
+        self.profiler = cProfile.Profile() if mode == "cprofile" else None
+        # collapsed stack -> number of samples, sampling mode only
+        self.samples = Counter()
+        self.thread_id = threading.get_ident()
+
+# running totals for one event name
+class EventSummary():
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.sql_count = 0
+        self.sql_time = 0.0
+        # statement -> seconds spent in it
+        self.statements = Counter()
+        # function -> seconds spent in it (not counting what it called)
+        self.hot_spots = Counter()
+
+    def add(self, profile: Profile, hot_spots: Counter):
+        self.count += 1
+        self.total_time += profile.duration
+        self.max_time = max(self.max_time, profile.duration)
+        self.sql_count += len(profile.statements)
+        for statement, duration in profile.statements:
+            self.sql_time += duration
+            self.statements[statement] += duration
+        self.hot_spots.update(hot_spots)
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "avg_ms": round(self.total_time / self.count * 1000, 3),
+            "max_ms": round(self.max_time * 1000, 3),
+            "avg_sql_statements": round(self.sql_count / self.count, 2),
+            "avg_sql_ms": round(self.sql_time / self.count * 1000, 3),
+            "slowest_sql": [{"statement": statement, "total_ms": round(seconds * 1000, 3)} for statement, seconds in self.statements.most_common(SUMMARY_SIZE)],
+            "hot_spots": [{"function": function, "total_ms": round(seconds * 1000, 3)} for function, seconds in self.hot_spots.most_common(SUMMARY_SIZE)],
+        }
+
+summaries: Dict[str, EventSummary] = {}
+summaries_lock = threading.Lock()
+
+# the profile running on the current thread, read by the SQL hooks and the sampler
+local = threading.local()
+
+
+# samples the stacks of the threads that are being profiled in sampling mode.
+# one thread for the whole app, started the first time it's needed
+class Sampler(threading.Thread):
+    def __init__(self):
+        super().__init__(name="profiling-sampler", daemon=True)
+        self.targets: Dict[int, Profile] = {}
+        self.lock = threading.Lock()
+
+    def run(self):
+        while True:
+            time.sleep(SAMPLING_INTERVAL)
+            # samples are added under the lock, once remove() returns the profile isn't touched again
+            with self.lock:
+                if not self.targets:
+                    continue
+                frames = sys._current_frames()
+                for thread_id, profile in self.targets.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        profile.samples[collapse_stack(frame)] += 1
+
+    def add(self, profile: Profile):
+        with self.lock:
+            self.targets[profile.thread_id] = profile
+
+    def remove(self, profile: Profile):
+        with self.lock:
+            self.targets.pop(profile.thread_id, None)
+
+sampler: Optional[Sampler] = None
+sampler_lock = threading.Lock()
+
+def get_sampler() -> Sampler:
+    global sampler
+    with sampler_lock:
+        if sampler is None:
+            sampler = Sampler()
+            sampler.start()
+        return sampler
+
+# writes finished profiles and adds them to the summaries, so the profiled
+# request or event doesn't pay for it. one thread, started the first time it's needed
+class Writer(threading.Thread):
+    def __init__(self):
+        super().__init__(name="profiling-writer", daemon=True)
+        self.queue = queue.Queue(maxsize=MAX_PENDING_PROFILES)
+
+    def run(self):
+        while True:
+            profile = self.queue.get()
+            try:
+                record(profile)
+            except Exception as e:
+                # a bad profile mustn't stop the thread, every later one would be lost
+                print(f"Could not record profile for {profile.event}: {e}")
+
+    def submit(self, profile: Profile):
+        try:
+            self.queue.put_nowait(profile)
+        except queue.Full:
+            print(f"Dropped profile for {profile.event}, the profile writer is behind")
+
+writer: Optional[Writer] = None
+writer_lock = threading.Lock()
+
+def get_writer() -> Writer:
+    global writer
+    with writer_lock:
+        if writer is None:
+            writer = Writer()
+            writer.start()
+        return writer
+
+def frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})"
+
+# root;caller;...;leaf, the format flamegraph tools read
+def collapse_stack(frame, max_depth: int = 64) -> str:
+    names = []
+    while frame is not None and len(names) < max_depth:
+        names.append(frame_name(frame))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+# records the SQL statements issued on a thread that's being profiled
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if getattr(local, "profile", None) is not None:
+        conn.info.setdefault("profiling_started", []).append(time.perf_counter())
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    profile = getattr(local, "profile", None)
+    if profile is not None and conn.info.get("profiling_started"):
+        started = conn.info["profiling_started"].pop()
+        profile.statements.append((statement, time.perf_counter() - started))
+
+sql_hooks_installed = False
+
+# the hooks are only installed once profiling is switched on, so the engine
+# isn't created at import and nothing is added to every query until then
+def install_sql_hooks():
+    global sql_hooks_installed
+    if sql_hooks_installed:
+        return
+    engine = db.get_engine()
+    sqlalchemy_event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    sqlalchemy_event.listen(engine, "after_cursor_execute", after_cursor_execute)
+    sql_hooks_installed = True
+
+
+# the settings usually come straight from a JSON request, so everything is checked
+# before anything is changed. raises ValueError for invalid settings
+def configure(enabled: bool = None, sample_rate: float = None, mode: str = None, events: list = None):
+    if enabled is not None and not isinstance(enabled, bool):
+        raise ValueError("enabled must be true or false")
+    if mode is not None and mode not in MODES:
+        raise ValueError(f"Unknown profiling mode {mode}, use one of {', '.join(MODES)}")
+    if sample_rate is not None:
+        if isinstance(sample_rate, bool) or not isinstance(sample_rate, (int, float)):
+            raise ValueError("sample_rate must be a number")
+        if not 0 < sample_rate <= 1:
+            raise ValueError("sample_rate must be between 0 and 1")
+    if events is not None:
+        if not isinstance(events, list) or not all(isinstance(event, str) for event in events):
+            raise ValueError("events must be a list of event names")
+
+    if mode is not None:
+        settings.mode = mode
+    if sample_rate is not None:
+        settings.sample_rate = sample_rate
+    if events is not None:
+        settings.events = set(events) or None
+    if enabled is not None:
+        if enabled:
+            install_sql_hooks()
+        settings.enabled = enabled
+
+def should_profile(event: str) -> bool:
+    if not settings.enabled:
+        return False
+    # nested handlers (a route calling another) are part of the outer profile
+    if getattr(local, "profile", None) is not None:
+        return False
+    if event in IGNORED_EVENTS:
+        return False
+    if settings.events is not None and event not in settings.events:
+        return False
+    return random.random() < settings.sample_rate
+
+# returns None if the profile couldn't be started, the request then just runs unprofiled
+def start(event: str) -> Optional[Profile]:
+    profile = Profile(event, settings.mode)
+    if profile.profiler is not None:
+        try:
+            profile.profiler.enable()
+        except ValueError:
+            # from python 3.12 only one cProfile can be enabled at a time,
+            # so a concurrent profiled request in cprofile mode is skipped
+            return None
+    else:
+        get_sampler().add(profile)
+    local.profile = profile
+    return profile
+
+def stop(profile: Profile):
+    if profile.profiler is not None:
+        profile.profiler.disable()
+    else:
+        get_sampler().remove(profile)
+    profile.duration = time.perf_counter() - profile.started
+    local.profile = None
+    get_writer().submit(profile)
+
+# runs on the writer thread
+def record(profile: Profile):
+    try:
+        save(profile)
+    except OSError as e:
+        print(f"Could not save profile for {profile.event}: {e}")
+    hot_spots = get_hot_spots(profile)
+    with summaries_lock:
+        summaries.setdefault(profile.event, EventSummary()).add(profile, hot_spots)
+
+# seconds spent in each function itself, from either kind of profile
+def get_hot_spots(profile: Profile) -> Counter:
+    hot_spots = Counter()
+    if profile.profiler is not None:
+        stats = pstats.Stats(profile.profiler).stats
+        for (filename, line, function), (_, _, own_time, _, _) in stats.items():
+            hot_spots[f"{function} ({Path(filename).name}:{line})"] += own_time
+    else:
+        for stack, count in profile.samples.items():
+            hot_spots[stack.rsplit(";", 1)[-1]] += count * SAMPLING_INTERVAL
+    return hot_spots
+
+def save(profile: Profile):
+    directory = PROFILE_DIR / re.sub(r"[^A-Za-z0-9_.-]", "_", profile.event)
+    directory.mkdir(parents=True, exist_ok=True)
+    name = f"{profile.started_at:%Y%m%dT%H%M%S}-{secrets.token_hex(3)}"
+
+    if profile.profiler is not None:
+        profile.profiler.dump_stats(directory / f"{name}.prof")
+    else:
+        with open(directory / f"{name}.folded", "w") as file:
+            for stack, count in profile.samples.items():
+                file.write(f"{stack} {count}\n")
+
+    with open(directory / f"{name}.json", "w") as file:
+        json.dump({
+            "event": profile.event,
+            "mode": profile.mode,
+            "started_at": profile.started_at.isoformat(),
+            "duration_ms": round(profile.duration * 1000, 3),
+            "sql": [{"statement": statement, "ms": round(duration * 1000, 3)} for statement, duration in profile.statements],
+        }, file, indent=2)
+    prune(directory)
+
+# deletes the oldest profiles of an event past MAX_PROFILES_PER_EVENT.
+# names start with the time they were taken, so they sort oldest first
+def prune(directory: Path):
+    names = sorted({path.name.split(".", 1)[0] for path in directory.iterdir()})
+    for name in names[:-MAX_PROFILES_PER_EVENT]:
+        for path in directory.glob(f"{name}.*"):
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                # another thread pruned it first
+                pass
+
+def summary():
+    with summaries_lock:
+        events = {name: event_summary.to_dict() for name, event_summary in summaries.items()}
+    return {
+        "enabled": settings.enabled,
+        "mode": settings.mode,
+        "sample_rate": settings.sample_rate,
+        "events_filter": sorted(settings.events) if settings.events else None,
+        "events": events,
+    }
+
+def reset():
+    with summaries_lock:
+        summaries.clear()
+
+
+# wraps a handler so that sampled calls are profiled under the given event name
+def profiled(event: str, handler):
+    @functools.wraps(handler)
+    def wrapper(*args, **kwargs):
+        if not should_profile(event):
+            return handler(*args, **kwargs)
+        profile = start(event)
+        if profile is None:
+            return handler(*args, **kwargs)
+        try:
+            return handler(*args, **kwargs)
+        finally:
+            stop(profile)
+    return wrapper
+
+def start_request_profile():
+    event = f"http:{request.endpoint}"
+    if should_profile(event):
+        g.profile = start(event)
+
+def stop_request_profile(_):
+    profile = g.pop("profile", None)
+    if profile is not None:
+        stop(profile)
+
+# hooks every route and every socket.io handler registered so far,
+# call it after socket_routes has been imported
+def init_app(app: Flask, socketio: SocketIO):
+    app.before_request(start_request_profile)
+    app.teardown_request(stop_request_profile)
+    for namespace, handlers in socketio.server.handlers.items():
+        for event_name, handler in list(handlers.items()):
+            handlers[event_name] = profiled(f"socket:{event_name}", handler)
@@ -0,0 +1,136 @@
+'''
+sessions
+server side login sessions
+
+the session table in the database is the source of truth.
+in front of it sits a bounded in-memory cache, so validating the session_token
+cookie of a request or socket event is usually a dict lookup instead of a query.
+a background thread sweeps expired sessions out of the table
+
+note that the cache is per process, a session ended in another process
+stays valid here until it expires or is pushed out of the cache
+'''
+
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import NamedTuple, Optional
+import threading
+import secrets
+import time
+import db
+
+# name of the cookie holding the session token
+SESSION_COOKIE = "session_token"
+SESSION_LIFETIME = timedelta(days=1)
+
+# how many validated sessions are kept in memory
+CACHE_SIZE = 10000
+# how often (in seconds) the sweeper deletes expired sessions
+SWEEP_INTERVAL = 600
+
+
+# what the cache keeps per token, everything a route needs to authorise a user
+class SessionUser(NamedTuple):
+    username: str
+    role_name: str
+    expires_at: datetime
+
+# least recently used cache of validated sessions
+class SessionCache():
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.entries: OrderedDict[str, SessionUser] = OrderedDict()
+        # socket.io handlers run on several threads
+        self.lock = threading.Lock()
+
+    def get(self, token: str) -> Optional[SessionUser]:
+        with self.lock:
+            entry = self.entries.get(token)
+            if entry is not None:
+                self.entries.move_to_end(token)
+            return entry
+
+    def put(self, token: str, entry: SessionUser):
+        with self.lock:
+            self.entries[token] = entry
+            self.entries.move_to_end(token)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def discard(self, token: str):
+        with self.lock:
+            self.entries.pop(token, None)
+
+    def discard_expired(self, now: datetime):
+        with self.lock:
+            expired = [token for token, entry in self.entries.items() if entry.expires_at <= now]
+            for token in expired:
+                del self.entries[token]
+
+cache = SessionCache(CACHE_SIZE)
+
+
+# starts a new session for the user, returns the token to put in the cookie
+def create(username: str, role_name: str) -> str:
+    start_sweeper()
+    token = secrets.token_urlsafe(32)
+    expires_at = datetime.utcnow() + SESSION_LIFETIME
+    db.create_session(token, username, expires_at)
+    cache.put(token, SessionUser(username, role_name, expires_at))
+    return token
+
+# returns the user the token belongs to, or None if the token is unknown or expired
+def validate(token: Optional[str]) -> Optional[SessionUser]:
+    if not token:
+        return None
+    start_sweeper()
+    now = datetime.utcnow()
+
+    entry = cache.get(token)
+    if entry is not None:
+        if entry.expires_at > now:
+            return entry
+        cache.discard(token)
+        return None
+
+    user_session = db.get_session(token)
+    if user_session is None or user_session.expires_at <= now:
+        return None
+    entry = SessionUser(user_session.username, user_session.user.role.name, user_session.expires_at)
+    cache.put(token, entry)
+    return entry
+
+def end(token: Optional[str]):
+    if not token:
+        return
+    cache.discard(token)
+    db.delete_session(token)
+
+
+sweeper_lock = threading.Lock()
+sweeper_thread: Optional[threading.Thread] = None
+
+def sweep():
+    now = datetime.utcnow()
+    cache.discard_expired(now)
+    return db.delete_expired_sessions(now)
+
+def sweep_forever():
+    while True:
+        time.sleep(SWEEP_INTERVAL)
+        try:
+            sweep()
+        except Exception as e:
+            # keep sweeping, a locked database shouldn't kill the thread
+            print(f"Session sweep failed: {e}")
+
+# the sweeper is started by the first session lookup rather than at import,
+# so processes that never serve a request (like the debug reloader) don't run one
+def start_sweeper():
+    global sweeper_thread
+    if sweeper_thread is not None:
+        return
+    with sweeper_lock:
+        if sweeper_thread is None:
+            sweeper_thread = threading.Thread(target=sweep_forever, name="session-sweeper", daemon=True)
+            sweeper_thread.start()
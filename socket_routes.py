@@ -4,8 +4,10 @@ file containing all the routes related to socket.io
 '''
 
 
-from flask_socketio import join_room, emit, leave_room
+from flask_socketio import join_room, emit, disconnect as close_socket
 from flask import request
+from datetime import datetime
+import functools
 from Crypto.Protocol.KDF import PBKDF2
 from Crypto.Hash import SHA256
 from Crypto.Cipher import AES
@@ -24,6 +26,44 @@ import app
 room = Room()
 online_users = {}
 
+# how many messages are sent when joining a room, and per load_history
+HISTORY_PAGE_SIZE = 50
+
+# for handlers that act as the logged in user, who is passed in as the first argument.
+# a socket opened before the session ended (logout in another tab, expiry) is closed
+def authenticated(handler):
+    @functools.wraps(handler)
+    def wrapper(*args):
+        user = app.current_user()
+        if user is None:
+            close_socket()
+            return "You are not logged in!"
+        return handler(user.username, *args)
+    return wrapper
+
+# room ids come from the client, anything but an int is turned away
+# (a list would otherwise end up as a dict key)
+def is_room_id(value) -> bool:
+    return isinstance(value, int) and not isinstance(value, bool)
+
+# the friend whose conversation a pairwise room is, None if it's not one of the user's
+def conversation_partner(username, room_id, friends=None):
+    if friends is None:
+        friends = db.get_friends(username)
+    return next((friend for friend in friends if room.room_id_for(username, friend) == room_id), None)
+
+# a user may be in the room of a conversation with a current friend,
+# or in a group chat they are a member of
+def may_join(username, room_id, friends=None):
+    return conversation_partner(username, room_id, friends) is not None or db.is_group_member(room_id, username)
+
+# messages and notices go to the sockets the registry has in the room,
+# skip_sid leaves the sender's own socket out
+def emit_to_room(room_id, event, args, skip_sid=None):
+    for sid in room.get_sids(room_id):
+        if sid != skip_sid:
+            emit(event, args, to=sid)
+
 # when the client connects to a socket
 # this event is emitted when the io() function is called in JS
 """@socketio.on('connect')
@@ -38,7 +78,11 @@ def connect():
     emit("incoming", (f"{username} has connected", "green"), to=int(room_id))"""
 @socketio.on('connect')
 def connect():
-    username = request.cookies.get("username")
+    # reject sockets without a valid session, this is usually a session cache hit
+    user = app.current_user()
+    if user is None:
+        return False
+    username = user.username
     if username:
         join_room(username)
         online_users[username] = request.sid
@@ -57,20 +101,22 @@ def connect():
         emit("online", {'user_list': list(online_users.keys())}, broadcast=True)
 
 
+        # the cookie is client controlled, only rejoin a room the user may be in
         room_id = request.cookies.get("room_id")
-        if room_id:
-            join_room(int(room_id))
-            emit("incoming", (f"{username} has connected", "green"), to=int(room_id))
+        if room_id and room_id.isdigit() and may_join(username, int(room_id), friends):
+            room.join_room(username, int(room_id), request.sid)
+            emit_to_room(int(room_id), "incoming", (f"{username} has connected", "green"))
 
 # event when client disconnects
 # quite unreliable use sparingly
 @socketio.on('disconnect')
 def disconnect():
-    username = request.cookies.get("username")
-    room_id = request.cookies.get("room_id")
-    if room_id is None or username is None:
-        return
-    emit("incoming", (f"{username} has disconnected", "red"), to=int(room_id))
+    user = app.current_user()
+    username = user.username if user else None
+    # only rooms the user is gone from entirely hear about it, another tab may still be open
+    for room_id in room.disconnect(request.sid):
+        if username is not None:
+            emit_to_room(room_id, "incoming", (f"{username} has disconnected", "red"))
     
     
     
@@ -92,28 +138,34 @@ def handle_disconnect():
 #    emit("incoming", (f"{username}: {message}"), to=room_id)
 
 @socketio.on("send")
-def send(sender, receiver, encryptedMessage, key, mac, room_id):
+@authenticated
+def send(sender, _sender, _receiver, encryptedMessage, key, mac, room_id):
+    # the client still sends both usernames as well, the room decides who the message is for.
+    # only members of the room can post to it, for group rooms this is everyone who joined
+    if not is_room_id(room_id) or not room.is_member(sender, room_id):
+        print(f"{sender} is not in room {room_id}")
+        return
 
-    sender_user = db.get_user(sender)
-    receiver_user = db.get_user(receiver)
-    sender_password = sender_user.password if sender_user else None
-    receiver_password = receiver_user.password if receiver_user else None
-    
-    if sender_password and receiver_password:
-        # The server acts as a middleman and does not decrypt the message
-        db.insert_message(sender, receiver, encryptedMessage, key, mac, sender_password, receiver_password) #NEW CODE
-        print(f"Message stored in the database")
-        emit("incoming", (sender, encryptedMessage, key, mac), to=room_id)
+    # The server acts as a middleman and does not decrypt the message
+    if db.is_chat_group(room_id):
+        db.insert_group_message(room_id, sender, encryptedMessage, key, mac)
     else:
-        print("Sender or receiver password not found in the database")
+        receiver = conversation_partner(sender, room_id)
+        sender_user = db.get_user(sender)
+        receiver_user = db.get_user(receiver) if receiver else None
+        if sender_user is None or receiver_user is None:
+            print("Sender or receiver password not found in the database")
+            return
+        db.insert_message(sender, receiver, encryptedMessage, key, mac, sender_user.password, receiver_user.password) #NEW CODE
+    print(f"Message stored in the database")
+    emit_to_room(room_id, "incoming", (sender, encryptedMessage, key, mac))
 
 # join room event handler
 # sent when the user joins a room
 @socketio.on("join")
-def join(sender_name, receiver_name):
-
-    sender = app.authenticate_user(sender_name) #WAYNE CODE
-    receiver = app.authenticate_user(receiver_name) #WAYNE CODE
+@authenticated
+def join(sender_name, _sender_name, receiver_name):
+    # the client still sends its own username as well, the one from the session is used
     print(f"Sender name: {sender_name}, Reciever Name: {receiver_name}")
 
     
@@ -130,43 +182,87 @@ def join(sender_name, receiver_name):
     sender_hashed_password = sender.password
     receiver_hashed_password = receiver.password
 
-    chat_history = db.get_chat_history(sender_name, receiver_name, sender_hashed_password, receiver_hashed_password)
-    print(f"Retrieved chat history: {chat_history}")
-
     if not db.are_friends(sender_name, receiver_name):
         return "You must be friends to join the chatroom!"
 
-    room_id = room.get_room_id(receiver_name)
+    # only the latest page, older ones are requested with load_history
+    chat_history = db.get_chat_history(sender_name, receiver_name, sender_hashed_password, receiver_hashed_password, limit=HISTORY_PAGE_SIZE)
+    print(f"Retrieved chat history: {chat_history}")
 
-    for message in chat_history: #NEW CODE
-        print(f"Emitting message: {message}")
-        emit("incoming", (message.sender, message.content, message.key, message.mac), room=request.sid) #NEW CODE
+    # the conversation always maps to the same room id
+    room_id = room.room_id_for(sender_name, receiver_name)
+    others_present = bool(room.get_members(room_id) - {sender_name})
 
-    # if the user is already inside of a room 
-    if room_id is not None:
-        
-        room.join_room(sender_name, room_id)
-        join_room(room_id)
+    send_history(chat_history)
+
+    room.join_room(sender_name, room_id, request.sid)
+
+    # if someone is already inside of the room 
+    if others_present:
         # emit to everyone in the room except the sender
-        emit("incoming", (f"{sender_name} has joined the room.", "green"), to=room_id, include_self=False)
+        emit_to_room(room_id, "incoming", (f"{sender_name} has joined the room.", "green"), skip_sid=request.sid)
         # emit only to the sender
         emit("incoming", (f"{sender_name} has joined the room. Now talking to {receiver_name}.", "green"))
         return room_id
 
-    # if the user isn't inside of any room, 
-    # perhaps this user has recently left a room
-    # or is simply a new user looking to chat with someone
-    room_id = room.create_room(sender_name, receiver_name)
-    join_room(room_id)
-    emit("incoming", (f"{sender_name} has joined the room. Now talking to {receiver_name}.", "green"), to=room_id)
+    # if nobody is inside of the room yet, 
+    # perhaps the other user has recently left
+    # or this is a new conversation
+    emit_to_room(room_id, "incoming", (f"{sender_name} has joined the room. Now talking to {receiver_name}.", "green"))
     return room_id
 
+# sends a page of history to the requesting socket, then where to continue from
+def send_history(messages):
+    for message in messages: #NEW CODE
+        emit("incoming", (message.sender, message.content, message.key, message.mac), room=request.sid) #NEW CODE
+    # a tuple, a bare None would be sent as an event without arguments
+    emit("history_cursor", (history_cursor(messages),), room=request.sid)
+
+# where the client should continue from to load older messages, None if there are none
+def history_cursor(messages):
+    if len(messages) < HISTORY_PAGE_SIZE:
+        return None
+    return messages[0].timestamp.isoformat()
+
+# sent when the user scrolls back past the messages shown,
+# returns the page of messages before the cursor (read from the archive if it's that old)
+@socketio.on("load_history")
+@authenticated
+def load_history(sender_name, room_id, before):
+    if not is_room_id(room_id) or not isinstance(before, str):
+        return "Invalid request!"
+    try:
+        before = datetime.fromisoformat(before)
+    except ValueError:
+        return "Invalid request!"
+
+    if db.is_group_member(room_id, sender_name):
+        messages = db.get_group_history(room_id, before=before, limit=HISTORY_PAGE_SIZE)
+    else:
+        receiver_name = conversation_partner(sender_name, room_id)
+        if receiver_name is None:
+            return "You must be friends to see the chat history!"
+        sender = db.get_user(sender_name)
+        receiver = db.get_user(receiver_name)
+        if sender is None or receiver is None:
+            return "Unknown user!"
+        messages = db.get_chat_history(sender_name, receiver_name, sender.password, receiver.password, before=before, limit=HISTORY_PAGE_SIZE)
+    return {
+        "messages": [(message.sender, message.content, message.key, message.mac) for message in messages],
+        "before": history_cursor(messages),
+    }
+
 # leave room event handler
 @socketio.on("leave")
-def leave(username, room_id):
-    emit("incoming", (f"{username} has left the room.", "red"), to=room_id)
-    leave_room(room_id)
-    room.leave_room(username)
+@authenticated
+def leave(username, _username, room_id):
+    if not is_room_id(room_id):
+        return
+    if room.is_member(username, room_id):
+        emit_to_room(room_id, "incoming", (f"{username} has left the room.", "red"))
+        room.leave_room(username, room_id)
+    # leaving a group chat is for good, it takes a new invitation to come back
+    db.remove_group_member(room_id, username)
 
 @socketio.on("friend_request_sent")
 def handle_friend_request_sent(sender, receiver):
@@ -197,6 +293,75 @@ def handle_friend_request_cancelled(sender, receiver):
     emit("friend_request_cancelled_receiver", (sender,), room=receiver)
 
 
+# batched friend request handlers, they act for the logged in user on a list of other users.
+# everything happens in one transaction and every affected user gets a single
+# friends_delta event instead of one round of events per request
+
+# collects the changes for each user, then sends one friends_delta per user
+class FriendsDelta():
+    FIELDS = ("friends_added", "requests_removed", "sent_requests_removed")
+
+    def __init__(self):
+        self.deltas = {}
+
+    def add(self, username, field, names):
+        delta = self.deltas.setdefault(username, {field: [] for field in self.FIELDS})
+        delta[field].extend(names)
+
+    def emit(self):
+        for username, delta in self.deltas.items():
+            emit("friends_delta", delta, room=username)
+
+# the batch events take a list straight from the client, anything else
+# (a bare string, nested lists, bools passed as ids) is turned away
+def is_list_of(value, item_type) -> bool:
+    return isinstance(value, list) and all(
+        isinstance(item, item_type) and not isinstance(item, bool) for item in value
+    )
+
+@socketio.on("friend_requests_accepted")
+@authenticated
+def handle_friend_requests_accepted(receiver, senders):
+    if not is_list_of(senders, str):
+        return []
+    accepted, removed = db.accept_friend_requests(receiver, senders)
+    delta = FriendsDelta()
+    delta.add(receiver, "friends_added", accepted)
+    delta.add(receiver, "requests_removed", removed)
+    for sender in accepted:
+        delta.add(sender, "friends_added", [receiver])
+    for sender in removed:
+        delta.add(sender, "sent_requests_removed", [receiver])
+    delta.emit()
+    return accepted
+
+@socketio.on("friend_requests_rejected")
+@authenticated
+def handle_friend_requests_rejected(receiver, senders):
+    if not is_list_of(senders, str):
+        return []
+    rejected = db.remove_friend_requests(receiver, senders, incoming=True)
+    delta = FriendsDelta()
+    delta.add(receiver, "requests_removed", rejected)
+    for sender in rejected:
+        delta.add(sender, "sent_requests_removed", [receiver])
+    delta.emit()
+    return rejected
+
+@socketio.on("friend_requests_cancelled")
+@authenticated
+def handle_friend_requests_cancelled(sender, receivers):
+    if not is_list_of(receivers, str):
+        return []
+    cancelled = db.remove_friend_requests(sender, receivers, incoming=False)
+    delta = FriendsDelta()
+    delta.add(sender, "sent_requests_removed", cancelled)
+    for receiver in cancelled:
+        delta.add(receiver, "requests_removed", [sender])
+    delta.emit()
+    return cancelled
+
+
 @socketio.on("friend_removed")
 def handle_friend_removed(user1, user2):
     db.remove_friendship(user1, user2)
@@ -207,19 +372,59 @@ def handle_friend_removed(user1, user2):
 
 
 @socketio.on("add_friend_to_chat")
-def add_friend_to_chat(room_id, friend_username):
-    sender = request.cookies.get("username")
+@authenticated
+def add_friend_to_chat(sender, room_id, friend_username):
+    if not is_room_id(room_id) or not isinstance(friend_username, str):
+        return {"success": False}
+    if not room.is_member(sender, room_id) or not db.are_friends(sender, friend_username):
+        return {"success": False}
+    # a conversation between two users stays private, inviting someone
+    # from it starts a new group chat that this tab moves into
+    if not db.is_chat_group(room_id):
+        room.leave_room(sender, room_id, request.sid)
+        room_id = db.create_chat_group(sender)
+        room.join_room(sender, room_id, request.sid)
     db.send_chat_invitation(sender, friend_username, room_id)
     emit("chat_invitation_sent", to=friend_username)
+    return {"success": True, "room_id": room_id}
 
 @socketio.on("accept_chat_invitation")
-def accept_chat_invitation(invitation_id):
-    invitation = db.get_chat_invitation(invitation_id)
-    if invitation:
-        room.join_room(invitation.receiver, invitation.room_id)
-        emit("incoming", (f"{invitation.receiver} has joined the chat.", "green"), to=invitation.room_id)
-        db.remove_chat_invitation(invitation_id)
+@authenticated
+def accept_chat_invitation(username, invitation_id):
+    room_ids = accept_chat_invitations.__wrapped__(username, [invitation_id])["room_ids"]
+    if not room_ids:
+        return {"success": False}
+    return {"success": True, "room_id": room_ids[0]}
 
 @socketio.on("reject_chat_invitation")
-def reject_chat_invitation(invitation_id):
-    db.remove_chat_invitation(invitation_id)
+@authenticated
+def reject_chat_invitation(username, invitation_id):
+    return reject_chat_invitations.__wrapped__(username, [invitation_id])
+
+# accepts many invitations at once, the invitations are removed in one transaction
+@socketio.on("accept_chat_invitations")
+@authenticated
+def accept_chat_invitations(username, invitation_ids):
+    if not is_list_of(invitation_ids, int):
+        return {"success": False, "room_ids": [], "invitation_ids": []}
+    invitations = db.take_chat_invitations(username, invitation_ids)
+    # invitations to a group that no longer exists are used up without joining anything
+    room_ids = [
+        room_id for room_id in dict.fromkeys(invitation.room_id for invitation in invitations)
+        if db.add_group_member(room_id, username)
+    ]
+    for room_id in room_ids:
+        room.join_room(username, room_id, request.sid)
+        emit_to_room(room_id, "incoming", (f"{username} has joined the chat.", "green"))
+    # the client shows the last room joined
+    if room_ids:
+        send_history(db.get_group_history(room_ids[-1], limit=HISTORY_PAGE_SIZE))
+    return {"success": bool(room_ids), "room_ids": room_ids, "invitation_ids": [invitation.id for invitation in invitations]}
+
+@socketio.on("reject_chat_invitations")
+@authenticated
+def reject_chat_invitations(username, invitation_ids):
+    if not is_list_of(invitation_ids, int):
+        return {"success": False, "invitation_ids": []}
+    invitations = db.take_chat_invitations(username, invitation_ids)
+    return {"success": True, "invitation_ids": [invitation.id for invitation in invitations]}
@@ -0,0 +1,453 @@
+let room_id = 0;
+let currentReceiver = "";
+
+$("#message").on("keyup", (e) => {
+    if (e.key == "Enter") {
+        send();
+    }
+});
+
+$("#receiver").on("keyup", (e) => {
+    if (e.key == "Enter") {
+        join_room();
+    }
+});
+
+$(document).ready(() => {
+    if (Cookies.get("room_id") == undefined) {
+        return;
+    }
+
+    $("#chat_box").hide();
+    $("#input_box").show();
+    room_id = parseInt(Cookies.get("room_id"));
+});
+
+const socket = io();
+
+//socket.on("incoming", (msg, color = "black") => {
+//    add_message(msg, color);
+//});
+
+// returns the decrypted message, or null if the MAC doesn't match
+function decrypt_message(encryptedMessage, key, mac) {
+    // Verify the MAC
+    let computedMac = CryptoJS.HmacSHA256(encryptedMessage, CryptoJS.enc.Utf8.parse(key)).toString();
+    if (computedMac !== mac) {
+        console.error("Message authentication failed!");
+        return null;
+    }
+    
+    // Decrypt the message using the key
+    return CryptoJS.AES.decrypt(encryptedMessage, key).toString(CryptoJS.enc.Utf8);
+}
+
+socket.on("incoming", (sender, encryptedMessage, key, mac, color = "black") => {
+    console.log("Received message from:", sender);
+    console.log("Encrypted message:", encryptedMessage);
+    console.log("Key:", key);
+    console.log("MAC:", mac);
+    
+    let decryptedMessage = decrypt_message(encryptedMessage, key, mac);
+    if (decryptedMessage === null) {
+        return;
+    }
+    
+    console.log("Decrypted message:", decryptedMessage);
+    
+    add_message(`${sender}: ${decryptedMessage}`, color);
+});
+
+// timestamp of the oldest message shown, older pages are loaded from before it.
+// null once there's nothing older
+let historyCursor = null;
+
+socket.on("history_cursor", (cursor) => {
+    // == null also catches undefined
+    historyCursor = cursor == null ? null : cursor;
+    $("#load_older").toggle(historyCursor !== null);
+});
+
+function loadOlderMessages() {
+    if (historyCursor == null) {
+        return;
+    }
+    socket.emit("load_history", room_id, historyCursor, (res) => {
+        if (typeof res == "string") {
+            alert(res);
+            return;
+        }
+        // prepend oldest last, so the page ends up in order above what's shown
+        res.messages.reverse().forEach(([sender, encryptedMessage, key, mac]) => {
+            let decryptedMessage = decrypt_message(encryptedMessage, key, mac);
+            if (decryptedMessage !== null) {
+                prepend_message(`${sender}: ${decryptedMessage}`, "black");
+            }
+        });
+        historyCursor = res.before == null ? null : res.before;
+        $("#load_older").toggle(historyCursor !== null);
+    });
+}
+
+socket.on("friends_list", (friends) => {
+    $("#friends").empty();
+    friends.forEach((friend) => {
+        $("#friends").append(`
+            <li>
+                <a href="/profile?username=${friend}">${friend}</a>
+                <button onclick="removeFriend('${username}', '${friend}')">Remove</button>
+            </li>
+        `);
+    });
+});
+
+socket.on("friend_requests_list", (friendRequests) => {
+    $("#friend_requests").empty();
+    friendRequests.forEach((sender) => {
+        $("#friend_requests").append(`
+            <li data-username="${sender}">
+                ${sender}
+                <button onclick="acceptFriendRequest('${username}', '${sender}')">Accept</button>
+                <button onclick="rejectFriendRequest('${username}', '${sender}')">Reject</button>
+            </li>
+        `);
+    });
+});
+
+socket.on("friend_request_received", (sender) => {
+    $("#friend_requests").append(`
+        <li data-username="${sender}">
+            ${sender}
+            <button onclick="acceptFriendRequest('${username}', '${sender}')">Accept</button>
+            <button onclick="rejectFriendRequest('${username}', '${sender}')">Reject</button>
+        </li>
+    `);
+});
+
+socket.on("friend_added", (friend) => {
+    $("#friends").append(`
+        <li>
+            <a href="/profile?username=${friend}">${friend}</a>
+            <button onclick="removeFriend('${username}', '${friend}')">Remove</button>
+        </li>
+    `);
+    $("#friend_requests li").filter(function() {
+        return $(this).text().trim().startsWith(friend);
+        //return $(this).text().trim() === friend;
+    }).remove();
+});
+
+socket.on("friend_request_rejected", (sender) => {
+    $("#friend_requests li").filter(function() {
+        return $(this).text().trim().startsWith(sender);
+    }).remove();
+});
+
+socket.on("friend_request_rejected_sender", (receiver) => {
+    $("#sent_friend_requests li").filter(function() {
+        return $(this).text().trim().startsWith(receiver);
+    }).remove();
+});
+
+socket.on("friend_removed", (friend) => {
+    $("#friends li").filter(function() {
+        return $(this).text().trim().startsWith(friend);
+    }).remove();
+    $("#receiver option[value='" + friend + "']").remove();
+});
+
+socket.on("sent_friend_requests_list", (sentFriendRequests) => {
+    $("#sent_friend_requests").empty();
+    sentFriendRequests.forEach((receiver) => {
+        $("#sent_friend_requests").append(`
+            <li data-username="${receiver}">
+                ${receiver}
+                <button onclick="cancelFriendRequest('${username}', '${receiver}')">Cancel</button>
+            </li>
+        `);
+    });
+});
+
+socket.on("friends_list_updated", (friends) => {
+    $("#receiver").empty();
+    $("#receiver").append('<option value="">Select a friend</option>');
+    friends.forEach((friend) => {
+        $("#receiver").append(`<option value="${friend}">${friend}</option>`);
+    });
+});
+
+socket.on("friend_request_accepted", (sender, receiver) => {
+    $("#sent_friend_requests li").filter(function() {
+        return $(this).text().trim().startsWith(receiver);
+    }).remove();
+});
+
+socket.on("friend_request_cancelled", (sender, receiver) => {
+    $("#sent_friend_requests li").filter(function() {
+        return $(this).text().trim().startsWith(receiver);
+    }).remove();
+});
+
+socket.on("friend_request_cancelled_receiver", (sender) => {
+    $("#friend_requests li").filter(function() {
+        return $(this).text().trim().startsWith(sender);
+    }).remove();
+});
+
+socket.on("friend_request_sent_success", (receiver) => {
+    $("#sent_friend_requests").append(`
+        <li data-username="${receiver}">
+            ${receiver}
+            <button onclick="cancelFriendRequest('${username}', '${receiver}')">Cancel</button>
+        </li>
+    `);
+});
+
+// one event per batch of friend request changes, see FriendsDelta in socket_routes.py
+socket.on("friends_delta", (delta) => {
+    delta.friends_added.forEach((friend) => {
+        $("#friends").append(`
+            <li>
+                <a href="/profile?username=${friend}">${friend}</a>
+                <button onclick="removeFriend('${username}', '${friend}')">Remove</button>
+            </li>
+        `);
+        $("#receiver").append(`<option value="${friend}">${friend}</option>`);
+    });
+    delta.requests_removed.forEach((sender) => {
+        $(`#friend_requests li[data-username="${sender}"]`).remove();
+    });
+    delta.sent_requests_removed.forEach((receiver) => {
+        $(`#sent_friend_requests li[data-username="${receiver}"]`).remove();
+    });
+});
+
+function send() {
+    let message = $("#message").val();
+    $("#message").val("");
+    
+    let receiver = currentReceiver
+
+    // Generate a random key for encryption
+    let key = CryptoJS.lib.WordArray.random(16).toString();
+    
+    // Encrypt the message using the key
+    let encryptedMessage = CryptoJS.AES.encrypt(message, key).toString();
+    
+    // Generate a MAC for the encrypted message
+    let mac = CryptoJS.HmacSHA256(encryptedMessage, CryptoJS.enc.Utf8.parse(key)).toString();
+    console.log("Sending message:", message);
+    console.log("Encrypted message:", encryptedMessage);
+    console.log("Key:", key);
+    console.log("MAC:", mac);
+    
+    // Send the encrypted message, key, and MAC to the server
+    socket.emit("send", username, receiver, encryptedMessage, key, mac, room_id);
+}
+
+function join_room() {
+    let receiver = $("#receiver").val();
+    currentReceiver = receiver; 
+    $("#message_box").empty(); //NEW CODE
+    socket.emit("join", username, receiver, (res) => {
+        if (typeof res != "number") {
+            alert(res);
+            return;
+        }
+
+        room_id = res;
+        Cookies.set("room_id", room_id);
+
+        $("#chat_box").hide();
+        $("#input_box").show();
+        
+    });
+}
+
+// shows a group chat, its messages are sent by the server when it's joined
+function enter_group_chat(group_room_id) {
+    room_id = group_room_id;
+    Cookies.set("room_id", room_id);
+    // group messages are addressed to the room, not to one receiver
+    currentReceiver = "";
+    $("#chat_box").hide();
+    $("#input_box").show();
+}
+
+function addFriendToChat() {
+    let selectedFriend = $("#friend_dropdown").val();
+    if (selectedFriend === "") {
+        return;
+    }
+    socket.emit("add_friend_to_chat", room_id, selectedFriend, (res) => {
+        if (!res.success) {
+            alert("Failed to invite " + selectedFriend + " to the chat.");
+            return;
+        }
+        // inviting someone to a conversation between two users starts a new group chat
+        if (res.room_id !== room_id) {
+            $("#message_box").empty();
+            historyCursor = null;
+            $("#load_older").hide();
+            enter_group_chat(res.room_id);
+        }
+    });
+}
+
+function leave() {
+    Cookies.remove("room_id");
+    socket.emit("leave", username, room_id);
+    $("#input_box").hide();
+    $("#chat_box").show();
+    $("#message_box").empty();
+}
+
+function add_message(message, color) {
+    let box = $("#message_box");
+    let child = $(`<p style="color:${color}; margin: 0px;"></p>`).text(message);
+    box.append(child);
+}
+
+function prepend_message(message, color) {
+    let box = $("#message_box");
+    let child = $(`<p style="color:${color}; margin: 0px;"></p>`).text(message);
+    box.prepend(child);
+}
+
+//function addFriend(username) {
+//    let friendUsername = $("#friend_username").val();
+//    socket.emit("friend_request_sent", username, friendUsername);
+//}
+function addFriend(username) {
+    let friendUsername = $("#friend_username").val();
+    socket.emit("friend_request_sent", username, friendUsername);
+    $("#friend_username").val("");
+}
+
+function acceptFriendRequest(username, friendUsername) {
+    socket.emit("friend_request_accepted", friendUsername, username);
+}
+
+function rejectFriendRequest(username, friendUsername) {
+    socket.emit("friend_request_rejected", friendUsername, username);
+}
+
+function removeFriend(username, friendUsername) {
+    socket.emit("friend_removed", username, friendUsername);
+}
+
+function cancelFriendRequest(username, friendUsername) {
+    socket.emit("friend_request_cancelled", username, friendUsername);
+}
+
+// usernames of every request currently shown in a list
+function listedUsernames(list) {
+    return $(`${list} li`).map(function() {
+        return $(this).attr("data-username");
+    }).get();
+}
+
+function acceptAllFriendRequests() {
+    socket.emit("friend_requests_accepted", listedUsernames("#friend_requests"));
+}
+
+function rejectAllFriendRequests() {
+    socket.emit("friend_requests_rejected", listedUsernames("#friend_requests"));
+}
+
+function cancelAllFriendRequests() {
+    socket.emit("friend_requests_cancelled", listedUsernames("#sent_friend_requests"));
+}
+
+function acceptChatInvitation(invitationId) {
+    // the group's latest messages arrive before the response
+    $("#message_box").empty();
+    socket.emit("accept_chat_invitation", invitationId, (response) => {
+        if (response.success) {
+            // Remove the accepted invitation from the list
+            $(`#chat_invitations li[data-invitation-id="${invitationId}"]`).remove();
+            // Join the chat room
+            enter_group_chat(response.room_id);
+        } else {
+            alert("Failed to accept the chat invitation.");
+        }
+    });
+}
+
+function rejectChatInvitation(invitationId) {
+    socket.emit("reject_chat_invitation", invitationId, () => {
+        // Remove the rejected invitation from the list
+        $(`#chat_invitations li[data-invitation-id="${invitationId}"]`).remove();
+    });
+}
+
+function listedInvitationIds() {
+    return $("#chat_invitations li").map(function() {
+        return parseInt($(this).attr("data-invitation-id"));
+    }).get();
+}
+
+function acceptAllChatInvitations() {
+    $("#message_box").empty();
+    socket.emit("accept_chat_invitations", listedInvitationIds(), (response) => {
+        response.invitation_ids.forEach((invitationId) => {
+            $(`#chat_invitations li[data-invitation-id="${invitationId}"]`).remove();
+        });
+        if (!response.success) {
+            alert("Failed to accept the chat invitations.");
+            return;
+        }
+        // the chat box shows the last room joined
+        enter_group_chat(response.room_ids[response.room_ids.length - 1]);
+    });
+}
+
+function rejectAllChatInvitations() {
+    socket.emit("reject_chat_invitations", listedInvitationIds(), (response) => {
+        response.invitation_ids.forEach((invitationId) => {
+            $(`#chat_invitations li[data-invitation-id="${invitationId}"]`).remove();
+        });
+    });
+}
+
+socket.on("chat_invitation_sent", () => {
+    alert("Chat invitation sent!");
+});
+
+socket.on('online', (data) => {
+    const { user_list } = data; 
+    user_list.forEach(lusername => {
+        if (lusername != username){
+            addToOnlineUsersList(lusername);
+        }
+    });
+});
+
+socket.on('offline', (data) => {
+    const { username } = data;
+    removeFromOnlineUsersList(username);
+});  
+
+function addToOnlineUsersList(lusername) {
+    const userList = document.getElementById('online_user_list');
+    const items = userList.getElementsByTagName('li');
+    for (let i = 0; i < items.length; i++) {
+        if (items[i].textContent === lusername) {
+            return;
+        }
+    }
+    const listItem = document.createElement('li');
+    listItem.textContent = lusername;
+    userList.appendChild(listItem);
+}
+
+function removeFromOnlineUsersList(username) {
+    const userList = document.getElementById('online_user_list');
+    const items = userList.getElementsByTagName('li');
+    for (let i = 0; i < items.length; i++) {
+        if (items[i].textContent === username) {
+            items[i].parentNode.removeChild(items[i]);
+            break;
+        }
+    }
+}
@@ -0,0 +1,60 @@
+document.getElementById("create_article_form").addEventListener("submit", async (e) => {
+    e.preventDefault();
+    const title = document.getElementById("article_title").value;
+    const content = document.getElementById("article_content").value;
+    const response = await axios.post("/create_article", { title, content });
+    if (response.data.success) {
+        location.reload();
+    } else {
+        alert("Failed to create article.");
+    }
+});
+
+document.querySelectorAll(".add-comment-form").forEach((form) => {
+    form.addEventListener("submit", async (e) => {
+        e.preventDefault();
+        const articleId = form.dataset.articleId;
+        const commentContent = form.elements.comment.value;
+        const response = await axios.post(`/create_comment/${articleId}`, { content: commentContent });
+        if (response.data.success) {
+            location.reload();
+        } else {
+            alert("Failed to add comment.");
+        }
+    });
+});
+
+async function editArticle(articleId) {
+    const title = prompt("Enter new title:");
+    const content = prompt("Enter new content:");
+    const response = await axios.post(`/edit_article/${articleId}`, { title, content });
+    if (response.data.success) {
+        location.reload();
+    } else {
+        alert("Failed to edit article.");
+    }
+}
+
+async function deleteArticle(articleId) {
+    const confirmation = confirm("Are you sure you want to delete this article?");
+    if (confirmation) {
+        const response = await axios.post(`/delete_article/${articleId}`);
+        if (response.data.success) {
+            location.reload();
+        } else {
+            alert("Failed to delete article.");
+        }
+    }
+}
+
+async function deleteComment(commentId) {
+    const confirmation = confirm("Are you sure you want to delete this comment?");
+    if (confirmation) {
+        const response = await axios.post(`/delete_comment/${commentId}`);
+        if (response.data.success) {
+            location.reload();
+        } else {
+            alert("Failed to delete comment.");
+        }
+    }
+}